@@ -1,5 +1,7 @@
 """Helpers to perform experiments with FLIM"""
 
 from ._dataset import LIDSDataset, ToLAB, ToTensor
+from ._gpu_preproc import lab_normalize
+from ._prefetcher import DataPrefetcher
 
-__all__ = ["LIDSDataset", "ToTensor", "ToLAB"]
+__all__ = ["LIDSDataset", "ToTensor", "ToLAB", "DataPrefetcher", "lab_normalize"]
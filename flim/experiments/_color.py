@@ -0,0 +1,154 @@
+import numpy as np
+from numba import njit, prange
+
+__all__ = ["rgb_to_lab_norm"]
+
+# RGB -> XYZ matrix rows and D65 white point used by pyift's LABNorm2 color space
+_RGB_TO_XYZ = np.array(
+    [
+        [0.4123955889674142161, 0.3575834307637148171, 0.1804926473817015735],
+        [0.2125862307855955516, 0.7151703037034108499, 0.07220049864333622685],
+        [0.01929721549174694484, 0.1191838645808485318, 0.9504971251315797660],
+    ]
+)
+_WHITE_POINT = np.array([0.950456, 1.0, 1.088754])
+
+# RGB -> (X/Xn, Y/Yn, Z/Zn) matrix
+_RGB_TO_XYZ_WHITE = _RGB_TO_XYZ / _WHITE_POINT[:, None]
+
+# unscaled contribution of each 8-bit value of each channel to X/Xn, Y/Yn, Z/Zn
+_U8_CONTRIBUTIONS = (
+    np.arange(256, dtype=np.float64)[:, None, None] * _RGB_TO_XYZ_WHITE.T[None]
+)
+
+_LAB_EPSILON = 8.85645167903563082e-3
+_LAB_KAPPA = 841.0 / 108.0
+_LAB_OFFSET = 4.0 / 29.0
+
+# (value - min) / (max - min) for each Lab channel
+_LAB_MIN = np.array([0.0, -86.182236, -107.867744])
+_LAB_RANGE = np.array([99.998337, 86.182236 + 98.258614, 107.867744 + 94.481682])
+
+# L = 116 fy - 16, a = 500 (fx - fy) and b = 200 (fy - fz) with the
+# normalization folded in, so each output channel is a single multiply-add
+_LAB_SCALE = np.array([116.0, 500.0, 200.0]) / _LAB_RANGE
+_LAB_SHIFT = (np.array([-16.0, 0.0, 0.0]) - _LAB_MIN) / _LAB_RANGE
+
+
+@njit(fastmath=True, cache=True)
+def _labf(x):
+    if x >= _LAB_EPSILON:
+        return np.cbrt(x)
+    return _LAB_KAPPA * x + _LAB_OFFSET
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _rgb_to_lab_norm_kernel(images, matrices, lab_scale, lab_shift, out):
+    n, height, width = images.shape[0], images.shape[1], images.shape[2]
+    # gray images have a single channel, read as R, G and B
+    g_channel, b_channel = (1, 2) if images.shape[3] > 1 else (0, 0)
+    for row in prange(n * height):
+        k, i = row // height, row % height
+        m = matrices[k]
+        for j in range(width):
+            r = images[k, i, j, 0]
+            g = images[k, i, j, g_channel]
+            b = images[k, i, j, b_channel]
+
+            fx = _labf(m[0, 0] * r + m[0, 1] * g + m[0, 2] * b)
+            fy = _labf(m[1, 0] * r + m[1, 1] * g + m[1, 2] * b)
+            fz = _labf(m[2, 0] * r + m[2, 1] * g + m[2, 2] * b)
+
+            out[k, i, j, 0] = lab_scale[0] * fy + lab_shift[0]
+            out[k, i, j, 1] = lab_scale[1] * (fx - fy) + lab_shift[1]
+            out[k, i, j, 2] = lab_scale[2] * (fy - fz) + lab_shift[2]
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _rgb_to_lab_norm_u8_kernel(images, luts, lab_scale, lab_shift, out):
+    n, height, width = images.shape[0], images.shape[1], images.shape[2]
+    # gray images have a single channel, read as R, G and B
+    g_channel, b_channel = (1, 2) if images.shape[3] > 1 else (0, 0)
+    for row in prange(n * height):
+        k, i = row // height, row % height
+        lut = luts[k]
+        for j in range(width):
+            r = images[k, i, j, 0]
+            g = images[k, i, j, g_channel]
+            b = images[k, i, j, b_channel]
+
+            fx = _labf(lut[r, 0, 0] + lut[g, 1, 0] + lut[b, 2, 0])
+            fy = _labf(lut[r, 0, 1] + lut[g, 1, 1] + lut[b, 2, 1])
+            fz = _labf(lut[r, 0, 2] + lut[g, 1, 2] + lut[b, 2, 2])
+
+            out[k, i, j, 0] = lab_scale[0] * fy + lab_shift[0]
+            out[k, i, j, 1] = lab_scale[1] * (fx - fy) + lab_shift[1]
+            out[k, i, j, 2] = lab_scale[2] * (fy - fz) + lab_shift[2]
+
+
+def _u8_luts(scales):
+    """Contribution of each 8-bit value of each RGB channel to X/Xn, Y/Yn, Z/Zn."""
+    return scales[:, None, None, None] * _U8_CONTRIBUTIONS[None]
+
+
+def rgb_to_lab_norm(image, out=None, channels_first=False):
+    """Convert an RGB image to the normalized Lab color space.
+
+    The image is scaled by its maximum value, converted to CIE Lab \
+    and each channel is normalized to :math:`[0, 1]`, \
+    in a single pass over the pixels. For 8-bit images, \
+    the scaled RGB to XYZ products are read from a 256-entry table.
+
+    Parameters
+    ----------
+    image : ndarray
+        RGB image with shape :math:`(H, W, 3)`, or a batch of \
+        RGB images with shape :math:`(N, H, W, 3)`. \
+        Gray images, with shape :math:`(H, W)` or :math:`(..., H, W, 1)`, \
+        are read as RGB images with equal channels. \
+        Each image of a batch is scaled by its own maximum value.
+    out : ndarray, optional
+        A float32 array to write the result, by default None.
+    channels_first : bool, optional
+        If True, the result has shape :math:`(3, H, W)` \
+        (or :math:`(N, 3, H, W)`), by default False.
+
+    Returns
+    -------
+    ndarray
+        The normalized Lab image with shape :math:`(H, W, 3)`, \
+        or :math:`(3, H, W)` if `channels_first` is True.
+
+    """
+    if image.ndim == 2:
+        image = image[..., None]
+
+    is_batch = image.ndim == 4
+    images = image if is_batch else image[None]
+
+    if out is None:
+        spatial_shape = image.shape[:-1]
+        if channels_first:
+            out_shape = (*spatial_shape[:-2], 3, *spatial_shape[-2:])
+        else:
+            out_shape = (*spatial_shape, 3)
+        out = np.empty(out_shape, np.float32)
+    _out = out if is_batch else out[None]
+
+    # the kernels write (N, H, W, 3) arrays, a channels first
+    # buffer is written through a strided view
+    if channels_first:
+        _out = _out.transpose(0, 2, 3, 1)
+
+    # not a reshape, which would copy strided views (e.g. RGBA without alpha)
+    scales = 1.0 / images.max(axis=(1, 2, 3)).astype(np.float64)
+
+    if images.dtype == np.uint8:
+        luts = _u8_luts(scales)
+        _rgb_to_lab_norm_u8_kernel(images, luts, _LAB_SCALE, _LAB_SHIFT, _out)
+    else:
+        # the scaling by the image maximum is folded into the matrix
+        matrices = scales[:, None, None] * _RGB_TO_XYZ_WHITE[None]
+        _rgb_to_lab_norm_kernel(images, matrices, _LAB_SCALE, _LAB_SHIFT, _out)
+
+    return out
@@ -6,7 +6,13 @@ import torch
 from skimage.color import rgb2lab
 from torch.utils.data import Dataset
 
-from ._image_utils import load_image
+from ._image_utils import (
+    _compile_lab_conversion,
+    _read_mimage_header,
+    load_image,
+    load_images,
+    load_mimage,
+)
 
 try:
     import pyift.pyift as ift
@@ -19,23 +25,52 @@ __all__ = ["LIDSDataset", "ToTensor", "ToLAB"]
 
 class LIDSDataset(Dataset):
     def __init__(
-        self, root_dir, split_dir=None, lab=True, transform=None, return_name=False
+        self,
+        root_dir,
+        split_dir=None,
+        lab=True,
+        transform=None,
+        return_name=False,
+        cache_dir=None,
+        mmap=True,
+        channels_first=False,
+        out_dtype=None,
     ):
         self.root_dir = root_dir
         self.split_dir = split_dir
         self.transform = transform
+        self.cache_dir = cache_dir
 
         self.return_name = return_name
         self.images_names = None
+        self._labels = None
+        self._paths = None
+        self._is_mimg = None
         self.opf_data = None
         self.opf_labels = None
 
         self._lab = lab
+        self._mmap = mmap
+        self._channels_first = channels_first
+        self._out_dtype = out_dtype
+        self._mimg_headers = {}
+
+        if self._out_dtype is not None and not self._channels_first:
+            raise ValueError("Parameter out_dtype requires channels_first=True.")
+
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
 
         if self.root_dir.endswith(".zip"):
             self.opf_data, self.opf_labels = self._get_data_from_opfdataset()
         else:
             self.images_names = self._list_images_files()
+            self._labels, self._paths, self._is_mimg = self._index_images()
+
+            if self._lab and len(self._paths) > 0:
+                _compile_lab_conversion(
+                    str(self._paths[0]), channels_first=self._channels_first
+                )
 
     def __len__(self):
         if self.opf_data is not None:
@@ -44,17 +79,80 @@ class LIDSDataset(Dataset):
 
     def __getitem__(self, idx):
         if self.opf_data is None:
-            image_path = os.path.join(self.root_dir, self.images_names[idx])
-
-            image = load_image(image_path, lab=self._lab)
+            path, is_mimg = self._paths[idx], self._is_mimg[idx]
+            image = self._load_image(path, is_mimg)
 
-            label = self._label_of_image(self.images_names[idx])
+            label = int(self._labels[idx])
 
         else:
 
             image = self.opf_data[idx]
             label = self.opf_labels[idx]
 
+        return self._make_sample(idx, image, label)
+
+    def get_batch(self, indices):
+        """Get the samples of a batch at once.
+
+        Images with the same shape are converted to Lab in a single call. \
+        ``DataLoader`` fetches whole batches through this method \
+        (PyTorch 2.0 or later), so samples are still collated as usual.
+
+        Parameters
+        ----------
+        indices : list[int]
+            Indices of the samples.
+
+        Returns
+        -------
+        list[tuple]
+            The samples, as returned by ``__getitem__``.
+
+        """
+        if self.opf_data is not None or self.cache_dir is not None:
+            return [self[idx] for idx in indices]
+
+        images = load_images(
+            [str(self._paths[idx]) for idx in indices],
+            lab=self._lab,
+            channels_first=self._channels_first,
+        )
+
+        return [
+            self._make_sample(idx, image, int(self._labels[idx]))
+            for idx, image in zip(indices, images)
+        ]
+
+    __getitems__ = get_batch
+
+    def _load_image(self, image_path, is_mimg):
+        image_path = str(image_path)
+        if is_mimg:
+            image = self._load_mimage(image_path)
+        elif self.cache_dir is not None:
+            image = self._load_cached_image(image_path)
+        elif self._channels_first:
+            # Lab images are written channels first by the conversion kernel
+            return load_images([image_path], lab=self._lab, channels_first=True)[0]
+        else:
+            image = load_image(image_path, lab=self._lab)
+
+        if self._channels_first and image.ndim > 2:
+            image = np.moveaxis(image, -1, 0)
+
+        return image
+
+    def _make_sample(self, idx, image, label):
+        if self._channels_first:
+            # memory-mapped images are read-only
+            if not image.flags.writeable:
+                image = image.copy()
+            image = torch.from_numpy(image)
+
+            # e.g. float16 halves the bytes copied to the device
+            if self._out_dtype is not None:
+                image = image.to(self._out_dtype)
+
         if self.transform:
             image = self.transform(image)
 
@@ -65,26 +163,81 @@ class LIDSDataset(Dataset):
 
         return sample
 
+    def _load_mimage(self, image_path):
+        if image_path not in self._mimg_headers:
+            self._mimg_headers[image_path] = _read_mimage_header(image_path)
+
+        return load_mimage(image_path, self._mimg_headers[image_path])
+
+    def _load_cached_image(self, image_path):
+        # the source file size and modification time invalidate stale entries
+        stat = os.stat(image_path)
+        cache_name = "{}.{}.{}-{}.npy".format(
+            os.path.basename(image_path),
+            "lab" if self._lab else "raw",
+            stat.st_mtime_ns,
+            stat.st_size,
+        )
+        cache_path = os.path.join(self.cache_dir, cache_name)
+
+        if os.path.exists(cache_path):
+            return np.load(cache_path, mmap_mode="r" if self._mmap else None)
+
+        image = load_image(image_path, lab=self._lab)
+
+        # write to a temporary file first so concurrent workers never read
+        # a partially written entry
+        tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.save(f, image)
+        os.replace(tmp_path, cache_path)
+
+        return image
+
     def _label_of_image(self, image_name):
         if not isinstance(image_name, str):
             raise TypeError("Parameter image_name must be a string.")
-        i = image_name.index("_")
-        label = int(image_name[0:i]) - 1
+        label = int(image_name.split("_", 1)[0]) - 1
 
         return label
 
+    def _index_images(self):
+        """Parse the labels, paths and .mimg flags of all images at once.
+
+        They are kept as parallel arrays indexed by the sample index, \
+        so getting a sample does no string work.
+
+        """
+        names = self.images_names
+
+        labels = np.fromiter(
+            (self._label_of_image(str(name)) for name in names),
+            dtype=np.int32,
+            count=len(names),
+        )
+        paths = np.char.add(os.path.join(self.root_dir, ""), names)
+        is_mimg = np.char.endswith(names, ".mimg")
+
+        return labels, paths, is_mimg
+
     def _list_images_files(self):
         if self.split_dir is not None:
             with open(self.split_dir, "r") as f:
-                _filenames = f.read()
+                filenames = list(filter(None, f.read().splitlines()))
+        else:
+            # scandir gets the file type from the directory entries,
+            # without a stat call per file; hidden files, such as the
+            # saved weights for balance, are not images
+            with os.scandir(self.root_dir) as entries:
                 filenames = [
-                    filename for filename in _filenames.split("\n") if len(filename) > 0
+                    entry.name
+                    for entry in entries
+                    if entry.is_file() and not entry.name.startswith(".")
                 ]
-        else:
 
-            filenames = os.listdir(self.root_dir)
-
-        return filenames
+        # a fixed-width string array is a single buffer, so it is cheap
+        # to copy into each DataLoader worker
+        return np.array(filenames, dtype=str)
 
     def _get_data_from_opfdataset(self):
         opfdataset = ift.ReadDataSet(self.root_dir)
@@ -96,26 +249,21 @@ class LIDSDataset(Dataset):
 
     def weights_for_balance(self, nclasses):
         weights_dir = os.path.join(
-            self.root_dir, ".weights-for-balance-{}.npy".format(self.image_list)
+            self.root_dir,
+            ".weights-for-balance-{}.npy".format(
+                os.path.basename(self.split_dir or "all")
+            ),
         )
 
         if os.path.exists(weights_dir):
             weight = np.load(weights_dir)
             return weight
 
-        count = [0] * nclasses
-        for image_name in self.images_names:
-            label = self._label_of_image(image_name)
-            count[label] += 1
-        weight_per_class = [0.0] * nclasses
-        N = float(sum(count))
-        for i in range(nclasses):
-            weight_per_class[i] = N / float(count[i])
-        weight = [0] * self.__len__()
-        for idx, image_name in enumerate(self.images_names):
-            label = self._label_of_image(image_name)
-            weight[idx] = weight_per_class[label]
-        weight = np.array(weight, dtype=np.float)
+        labels = self._labels
+        # float32 is enough for sampling weights
+        count = np.bincount(labels, minlength=nclasses).astype(np.float32)
+        weight_per_class = labels.size / count
+        weight = weight_per_class[labels]
 
         np.save(weights_dir, weight)
 
@@ -124,6 +272,12 @@ class LIDSDataset(Dataset):
 
 class ToTensor(object):
     def __call__(self, sample):
+        if isinstance(sample, torch.Tensor):
+            # keep half precision samples, see LIDSDataset's out_dtype
+            if sample.dtype in (torch.float16, torch.bfloat16):
+                return sample
+            return sample.float()
+
         image = np.array(sample)
 
         # min = image.min()
@@ -0,0 +1,61 @@
+import torch
+
+from ._color import (
+    _LAB_EPSILON,
+    _LAB_KAPPA,
+    _LAB_OFFSET,
+    _LAB_SCALE,
+    _LAB_SHIFT,
+    _RGB_TO_XYZ_WHITE,
+)
+
+__all__ = ["lab_normalize"]
+
+
+def lab_normalize(images):
+    """Convert RGB images to the normalized Lab color space on their device.
+
+    This is the tensor counterpart of the conversion done by \
+    ``LIDSDataset``: it gives the same result, but runs on the device \
+    of `images`. Load the raw images with \
+    ``LIDSDataset(..., lab=False, channels_first=True)``, copy each batch \
+    to the GPU (e.g. with ``DataPrefetcher``) and convert it there. \
+    The data loader workers then only decode images, and the \
+    copies to the device are 8-bit, a quarter of the float32 size.
+
+    Parameters
+    ----------
+    images : torch.Tensor
+        RGB images with shape :math:`(N, 3, H, W)` or :math:`(3, H, W)`. \
+        Each image is scaled by its own maximum value.
+
+    Returns
+    -------
+    torch.Tensor
+        The float32 normalized Lab images, with the shape of `images`.
+
+    """
+    is_batch = images.ndim == 4
+    x = (images if is_batch else images[None]).float()
+
+    # the scaling by each image maximum is folded into the RGB -> XYZ matrix
+    scales = 1.0 / x.flatten(1).amax(dim=1)
+    rgb_to_xyz = torch.as_tensor(_RGB_TO_XYZ_WHITE, dtype=x.dtype, device=x.device)
+    matrices = scales[:, None, None] * rgb_to_xyz
+
+    xyz = torch.einsum("nij,njhw->nihw", matrices, x)
+
+    f = torch.where(
+        xyz >= _LAB_EPSILON,
+        xyz.clamp(min=_LAB_EPSILON).pow(1.0 / 3.0),
+        _LAB_KAPPA * xyz + _LAB_OFFSET,
+    )
+    fx, fy, fz = f.unbind(dim=1)
+
+    lab = torch.stack([fy, fx - fy, fy - fz], dim=1)
+
+    lab_scale = torch.as_tensor(_LAB_SCALE, dtype=x.dtype, device=x.device)
+    lab_shift = torch.as_tensor(_LAB_SHIFT, dtype=x.dtype, device=x.device)
+    lab = torch.addcmul(lab_shift[:, None, None], lab_scale[:, None, None], lab)
+
+    return lab if is_batch else lab[0]
@@ -1,3 +1,5 @@
+import os
+import threading
 import warnings
 
 import nibabel as nib
@@ -6,6 +8,8 @@ from PIL import Image
 from skimage.color import gray2rgb, lab2rgb, rgba2rgb
 from skimage.util import img_as_float
 
+from ._color import rgb_to_lab_norm
+
 try:
     import pyift.pyift as ift
 except ModuleNotFoundError:
@@ -19,14 +23,17 @@ __all__ = [
     "load_mimage",
     "save_mimage",
     "image_to_lab",
+    "load_images",
 ]
 
+_scratch = threading.local()
 
-def _labf(x):
-    if x >= 8.85645167903563082e-3:
-        return x ** (0.33333333333)
-    else:
-        return (841.0 / 108.0) * (x) + (4.0 / 29.0)
+_MIMAGE_MAX_HEADER_SIZE = 256
+
+# modes that PIL converts to RGB, gray and RGBA images are handled by _to_rgb
+_RGB_MODES = ("1", "P", "LA", "YCbCr")
+
+_2D_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".pgm", ".ppm")
 
 
 def image_to_lab(image):
@@ -34,61 +41,53 @@ def image_to_lab(image):
 
 
 def _image_to_lab(image):
-    image = image / image.max()
+    return rgb_to_lab_norm(image)
 
-    labf_v = np.vectorize(_labf)
 
-    new_image = np.zeros_like(image)
+def _to_rgb(image):
+    """Get an image the Lab conversion reads as RGB.
 
-    R, G, B = image[:, :, 0], image[:, :, 1], image[:, :, 2]
+    Gray images are returned with a single channel, which the conversion \
+    reads as R, G and B, and opaque RGBA images as a view without alpha, \
+    so neither is copied.
+
+    """
+    if image.ndim == 3 and image.shape[-1] == 4:
+        if _is_opaque(image):
+            image = image[..., :3]
+        else:
+            image = rgba2rgb(image)
+    elif image.ndim == 2:
+        image = image[..., None]
+    elif image.ndim == 3 and image.shape[-1] > 4:
+        image = gray2rgb(image)
+    elif image.ndim == 4 and image.shape[-1] == 4:
+        image = rgba2rgb(image)
+
+    return image
 
-    X = (
-        0.4123955889674142161 * R
-        + 0.3575834307637148171 * G
-        + 0.1804926473817015735 * B
-    )
-    Y = (
-        0.2125862307855955516 * R
-        + 0.7151703037034108499 * G
-        + 0.07220049864333622685 * B
-    )
-    Z = (
-        0.01929721549174694484 * R
-        + 0.1191838645808485318 * G
-        + 0.9504971251315797660 * B
-    )
 
-    X = labf_v(X / 0.950456)
-    Y = labf_v(Y / 1.0)
-    Z = labf_v(Z / 1.088754)
+def _is_opaque(image):
+    alpha_max = np.iinfo(image.dtype).max if image.dtype.kind in "ui" else 1.0
+    return bool((image[..., 3] == alpha_max).all())
 
-    new_image[:, :, 0] = 116 * Y - 16
-    new_image[:, :, 1] = 500 * (X - Y)
-    new_image[:, :, 2] = 200 * (Y - Z)
 
-    # new_image = rgb2lab(image)
+def _read_2d_image(path, lab=True):
+    with Image.open(path) as image:
+        if not lab:
+            return np.array(image)
 
-    new_image[:, :, 0] = new_image[:, :, 0] / 99.998337
-    new_image[:, :, 1] = (new_image[:, :, 1] + 86.182236) / (86.182236 + 98.258614)
-    new_image[:, :, 2] = (new_image[:, :, 2] + 107.867744) / (107.867744 + 94.481682)
+        # PIL decodes these modes straight into 8-bit RGB
+        if image.mode in _RGB_MODES:
+            image = image.convert("RGB")
 
-    return new_image
+        return np.asarray(image)
 
 
 def load_and_convert_2d_images(path, lab: bool = True) -> np.ndarray:
-    image = Image.open(path)
-    image = np.array(image)
+    image = _read_2d_image(path, lab)
     if lab:
-        if image.ndim == 3 and image.shape[-1] == 4:
-            image = rgba2rgb(image)
-        elif image.ndim == 2 or image.shape[-1] == 1:
-            image = gray2rgb(image)
-        elif image.ndim == 3 and image.shape[-1] > 4:
-            image = gray2rgb(image)
-        elif image.ndim == 4 and image.shape[-1] == 4:
-            image = rgba2rgb(image)
-
-        image = _image_to_lab(image)
+        image = _image_to_lab(_to_rgb(image))
 
         if image.dtype != float:
             image = img_as_float(image)
@@ -136,6 +135,77 @@ def load_image(path: str, lab: bool = True) -> np.ndarray:
     return image
 
 
+def load_images(paths, lab: bool = True, channels_first: bool = False) -> list:
+    """Load a list of images.
+
+    2D images with the same shape are stacked and \
+    converted to Lab with a single call. If `channels_first` is True, \
+    images are returned with the channels in the first axis.
+
+    """
+    if not lab or not all(path.lower().endswith(_2D_EXTENSIONS) for path in paths):
+        images = [load_image(path, lab=lab) for path in paths]
+        if channels_first:
+            images = [
+                np.moveaxis(image, -1, 0) if image.ndim > 2 else image
+                for image in images
+            ]
+        return images
+
+    images = [_to_rgb(_read_2d_image(path)) for path in paths]
+
+    if len(images) == 1 or len({image.shape for image in images}) > 1:
+        return [
+            rgb_to_lab_norm(image, channels_first=channels_first) for image in images
+        ]
+
+    batch = np.stack(images, out=_stacking_buffer(len(images), images))
+
+    return list(rgb_to_lab_norm(batch, channels_first=channels_first))
+
+
+def _compile_lab_conversion(path, channels_first=False):
+    """Compile the Lab conversion kernels for images like the one in `path`.
+
+    Numba compiles a kernel for each input dtype and memory layout. \
+    Converting a few pixels of an image ahead of time, in the main \
+    process, means that forked DataLoader workers inherit the compiled \
+    kernels instead of compiling them each on their first sample.
+
+    """
+    if not path.lower().endswith(_2D_EXTENSIONS):
+        return
+
+    # a contiguous 2x2 crop has the memory layout of the whole image,
+    # size 1 axes would make the channels first output contiguous
+    image = _read_2d_image(path)
+    crop = np.ascontiguousarray(image[:2, :2])
+    crop.flags.writeable = image.flags.writeable
+    image = _to_rgb(crop)
+
+    # kernels for single images and for stacked batches
+    rgb_to_lab_norm(image, channels_first=channels_first)
+    rgb_to_lab_norm(np.stack([image, image]), channels_first=channels_first)
+
+
+def _stacking_buffer(n, images):
+    """Get a buffer to stack images, reused while batches keep the same shape.
+
+    Each DataLoader worker is a process, so the buffer is \
+    never shared between workers.
+
+    """
+    shape = (n, *images[0].shape)
+    dtype = np.result_type(*images)
+
+    buffer = getattr(_scratch, "stacking_buffer", None)
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        buffer = np.empty(shape, dtype=dtype)
+        _scratch.stacking_buffer = buffer
+
+    return buffer
+
+
 def image_to_rgb(image):
     warnings.warn(
         "'image_to_rgb' will be remove due to its misleading name. "
@@ -151,7 +221,44 @@ def from_lab_to_rgb(image):
     return image
 
 
-def load_mimage(path):
+def _read_mimage_header(path):
+    """Find the layout of the float32 pixels of a .mimg file.
+
+    The file has a text header with the line ``xsize ysize zsize n_bands`` \
+    followed by the raw pixel values. Returns None if the file \
+    does not match this layout, so that it can be read with PyIFT.
+
+    """
+    with open(path, "rb") as f:
+        header = f.read(_MIMAGE_MAX_HEADER_SIZE)
+
+    for line in header.split(b"\n")[:-1]:
+        tokens = line.split()
+        if len(tokens) == 4 and all(token.isdigit() for token in tokens):
+            xsize, ysize, zsize, n_bands = (int(token) for token in tokens)
+            break
+    else:
+        return None
+
+    shape = (zsize, ysize, xsize, n_bands)
+    offset = os.path.getsize(path) - np.prod(shape) * np.dtype(np.float32).itemsize
+
+    if not 0 < offset <= len(header) or header[offset - 1 : offset] != b"\n":
+        return None
+
+    return np.float32, shape, int(offset)
+
+
+def load_mimage(path, header=None):
+    if header is None:
+        header = _read_mimage_header(path)
+
+    if header is not None:
+        dtype, shape, offset = header
+        return np.memmap(
+            path, dtype=dtype, mode="r", offset=offset, shape=shape
+        ).squeeze()
+
     assert ift is not None, "PyIFT is not available"
 
     mimage = ift.ReadMImage(path)
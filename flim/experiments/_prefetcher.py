@@ -0,0 +1,70 @@
+import torch
+
+__all__ = ["DataPrefetcher"]
+
+
+class DataPrefetcher:
+    """Copy the next batch to the device while the current one is used.
+
+    On CUDA devices, batches are copied in a side stream with \
+    non-blocking copies, so the host to device transfer overlaps \
+    with the computation on the current batch. The copies are only \
+    asynchronous if the batches are in pinned memory, so the data loader \
+    should be created with ``pin_memory=True``, and with enough \
+    ``num_workers`` (and ``persistent_workers=True``) to keep up \
+    with the device. On other devices, batches are simply moved to it.
+
+    Parameters
+    ----------
+    loader : Iterable
+        A data loader yielding tuples of tensors.
+    device : str or torch.device
+        Device where the batches are copied to.
+
+    """
+
+    def __init__(self, loader, device):
+        self._loader = loader
+        self._device = torch.device(device)
+
+        if self._device.type == "cuda":
+            self._stream = torch.cuda.Stream(self._device)
+        else:
+            self._stream = None
+
+    def __len__(self):
+        return len(self._loader)
+
+    def __iter__(self):
+        loader_iter = iter(self._loader)
+
+        next_batch = self._preload(loader_iter)
+        while next_batch is not None:
+            if self._stream is not None:
+                current_stream = torch.cuda.current_stream(self._device)
+                current_stream.wait_stream(self._stream)
+                for data in next_batch:
+                    if isinstance(data, torch.Tensor):
+                        data.record_stream(current_stream)
+
+            batch = next_batch
+            next_batch = self._preload(loader_iter)
+
+            yield batch
+
+    def _preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+
+        if self._stream is None:
+            return [self._to_device(data) for data in batch]
+
+        with torch.cuda.stream(self._stream):
+            return [self._to_device(data, non_blocking=True) for data in batch]
+
+    def _to_device(self, data, non_blocking=False):
+        if isinstance(data, torch.Tensor):
+            return data.to(self._device, non_blocking=non_blocking)
+        return data
@@ -37,6 +37,7 @@ from ..models.lcn import (
 )
 from ._dataset import LIDSDataset
 from ._image_utils import *
+from ._prefetcher import DataPrefetcher
 
 try:
     import pyift.pyift as ift
@@ -46,35 +47,30 @@ except ModuleNotFoundError:
 
 
 def load_markers(markers_dir):
-    markers = []
-    lines = None
     with open(markers_dir, "r") as f:
-        lines = f.readlines()
+        label_infos = [int(info) for info in f.readline().split(" ")]
 
-    label_infos = [int(info) for info in lines[0].split(" ")]
+        is_2d = len(label_infos) == 3
 
-    is_2d = len(label_infos) == 3
-
-    if is_2d:
-        image_shape = (label_infos[2], label_infos[1])
-    else:
-        image_shape = (label_infos[2], label_infos[1], label_infos[3])
-
-    markers = np.zeros(image_shape, dtype=int)
-
-    for line in lines[1:]:
-        split_line = line.split(" ")
         if is_2d:
-            y, x, label = int(split_line[0]), int(split_line[1]), int(split_line[3])
-            markers[x][y] = label
+            image_shape = (label_infos[2], label_infos[1])
+            # "y x -1 label" lines
+            columns = (0, 1, 3)
         else:
-            y, x, z, label = (
-                int(split_line[0]),
-                int(split_line[1]),
-                int(split_line[2]),
-                int(split_line[4]),
+            image_shape = (label_infos[2], label_infos[1], label_infos[3])
+            # "y x z -1 label" lines
+            columns = (0, 1, 2, 4)
+
+        markers = np.zeros(image_shape, dtype=int)
+
+        # all the markers lines at once
+        if label_infos[0] > 0:
+            *coords, label = np.loadtxt(
+                f, dtype=np.int64, usecols=columns, ndmin=2, unpack=True
             )
-            markers[x][y][z] = label
+            # images dimensions are flipped
+            coords[0], coords[1] = coords[1], coords[0]
+            markers[tuple(coords)] = label
 
     return markers
 
@@ -359,7 +355,11 @@ def train_model(
     #    torch.backends.cudnn.deterministic = True
 
     dataloader = DataLoader(
-        train_set, batch_size=batch_size, shuffle=True, drop_last=False
+        train_set,
+        batch_size=batch_size,
+        shuffle=True,
+        drop_last=False,
+        pin_memory=torch.device(device).type == "cuda",
     )
 
     model.to(device)
@@ -402,9 +402,10 @@ def train_model(
         running_corrects = 0.0
         n = 0
 
-        for i, data in enumerate(dataloader, 0):
+        for i, data in enumerate(DataPrefetcher(dataloader, device), 0):
             inputs, labels = data
-            inputs, labels = inputs.to(device), labels.to(device)
+            if inputs.dim() == 4:
+                inputs = inputs.contiguous(memory_format=torch.channels_last)
             optimizer.zero_grad()
 
             outputs = model(inputs)
@@ -844,15 +845,10 @@ def validate_svm(model, clf, val_set, batch_size=32, device="cpu"):
 
 
 def _images_close_to_center(images, centers):
-    _images = []
-    for center in centers:
-        _center = np.expand_dims(center, 0)
-
-        dist = cdist(images, _center)
+    # the distances to all centers with a single call
+    dist = cdist(images, centers)
 
-        _images.append(images[np.argmin(dist)])
-
-    return np.array(_images)
+    return images[np.argmin(dist, axis=0)]
 
 
 def _find_elems_in_array(a, elems):
@@ -892,27 +888,24 @@ def select_images_to_put_markers(dataset, class_proportion=4, random=True):
     else:
         dataloader = DataLoader(dataset, batch_size=64, shuffle=False, drop_last=False)
 
-        all_images = None
-        all_labels = None
+        all_images = []
+        all_labels = []
 
         input_shape = dataset[0][0].shape
 
         for images, labels in dataloader:
-            if all_images is None:
-                all_images = images
-                all_labels = labels
-            else:
-                all_images = torch.cat((all_images, images))
-                all_labels = torch.cat((all_labels, labels))
+            all_images.append(images)
+            all_labels.append(labels)
 
-        all_images = all_images.flatten(1).numpy()
-        all_labels = all_labels.numpy()
+        # a single copy, instead of one growing concatenation per batch
+        all_images = torch.cat(all_images).flatten(1).numpy()
+        all_labels = torch.cat(all_labels).numpy()
 
         possible_labels = np.unique(all_labels)
 
         images_names = []
 
-        roots = None
+        roots = []
 
         for label in possible_labels:
             images_of_label = all_images[all_labels == label]
@@ -931,17 +924,14 @@ def select_images_to_put_markers(dataset, class_proportion=4, random=True):
                 images_of_label, kmeans.cluster_centers_
             )
 
-            if roots is None:
-                roots = roots_of_label
-            else:
-                roots = np.concatenate((roots, roots_of_label))
+            roots.append(roots_of_label)
 
             indices = _find_elems_in_array(all_images, roots_of_label)
 
             for indice in indices:
                 images_names.append(dataset.images_names[indice])
 
-            selected_images = roots.reshape(-1, *input_shape)
+        selected_images = np.concatenate(roots).reshape(-1, *input_shape)
 
     return selected_images, images_names
 
@@ -6,11 +6,9 @@ import warnings
 import numpy as np
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
+from numba import njit, prange
 from scipy.spatial import distance
-from skimage.util import view_as_windows
-from sklearn.cluster import KMeans
-from sklearn.decomposition import PCA
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.metrics.pairwise import (
     _euclidean_distances,
     cosine_similarity,
@@ -24,6 +22,11 @@ from ._decoder import Decoder
 from ._lcn import LIDSConvNet, ParallelModule
 from ._marker_based_norm import MarkerBasedNorm2d, MarkerBasedNorm3d
 
+try:
+    import faiss
+except ModuleNotFoundError:
+    faiss = None
+
 __all__ = ["LCNCreator"]
 
 # TODO I think adaptative pooling 2D is missing
@@ -49,6 +52,10 @@ __operations__ = {
     "decoder": Decoder,
 }
 
+# operations that are the identity at inference, so the activations
+# of the layers are not computed for them while building
+_IDENTITY_OPERATIONS = ("dropout",)
+
 
 class LabelSmoothingLoss(nn.Module):
     def __init__(self, classes, smoothing=0.0, dim=-1, weight=None):
@@ -110,6 +117,7 @@ class NetworkDiGraph:
     def __init__(self, arch):
         self._arch = arch
         self._vertex_dict = {}
+        self._dilations_due_to_pool = {}
 
         self._create_digraph_representation()
 
@@ -160,14 +168,37 @@ class NetworkDiGraph:
     def dfs_from_vertex(self, vertex_name):
         vertex = self._vertex_dict[vertex_name]
         visited = set()
-        stack = []
-        stack.extend(vertex.neighbors)
+        stack = list(vertex.neighbors)
         while stack:
             vertex = stack.pop()
             if vertex not in visited:
                 visited.add(vertex)
                 yield vertex
-                stack.extend(vertex.neighbors)
+                # visited vertices are not pushed again
+                stack.extend(
+                    neighbor for neighbor in vertex.neighbors if neighbor not in visited
+                )
+
+    def dilation_due_to_pool(self, vertex_name):
+        """Get the product of the strides of the poolings before a vertex.
+
+        The result is cached, since it walks all the layers before the vertex.
+
+        """
+        if vertex_name not in self._dilations_due_to_pool:
+            dilation = 1
+            for node in self.dfs_from_vertex(vertex_name):
+                if (
+                    not node.is_module
+                    and node.arch
+                    and "pool" in node.arch["operation"]
+                ):
+                    if node.arch["params"]["stride"] > 1:
+                        dilation *= node.arch["params"]["stride"]
+
+            self._dilations_due_to_pool[vertex_name] = dilation
+
+        return self._dilations_due_to_pool[vertex_name]
 
 
 class LCNCreator:
@@ -204,6 +235,7 @@ class LCNCreator:
         random_state=None,
         multilevel_clustering=True,
         verbose=False,
+        compile_layers=False,
     ):
         """Initialize the class.
 
@@ -225,25 +257,37 @@ class LCNCreator:
             Change markers labels so that each connected component has a \
             different label, by default True.
         device : str, optional
-            Device where to do the computation, by default 'cpu'.
+            Device where to do the computation, by default 'cpu'. \
+            While a layer is built, the device holds its inputs for all \
+            the images and, if they fit in half of the free memory, \
+            its outputs, otherwise these are kept in pinned host memory.
         superpixels_markers : ndarray, optional
             Extra images markers get from superpixel segmentation, \
             by default None.
+        compile_layers : bool, optional
+            On CUDA devices, run the layers over the images with \
+            ``torch.compile``, by default False. It pays off for large \
+            sets of images, where it saves more time than it takes to compile.
 
         """
         assert architecture is not None
 
+        # int32 labels, without a copy when they already are
         if superpixels_markers is not None:
-            self._superpixel_markers = np.expand_dims(superpixels_markers, 0).astype(
-                np.int32
+            self._superpixel_markers = np.asarray(superpixels_markers)[None].astype(
+                np.int32, copy=False
             )
             self._has_superpixel_markers = True
 
         else:
             self._has_superpixel_markers = False
 
+        # a single cast, so the layers wrap the images without copies
+        if images is not None:
+            images = np.ascontiguousarray(images, dtype=np.float32)
+
         if markers is not None:
-            markers = markers.astype(int)
+            markers = np.ascontiguousarray(markers, dtype=np.int32)
 
         self._feature_extractor = nn.Sequential()
         self._relabel_markers = relabel_markers
@@ -253,6 +297,7 @@ class LCNCreator:
         self._architecture = architecture
         self._multilevel_clustering = multilevel_clustering
         self._verbose = verbose
+        self._compile_layers = compile_layers
 
         if images is None:
             self._in_channels = input_shape[-1]
@@ -270,7 +315,8 @@ class LCNCreator:
 
         self.random_state = random_state
 
-        self._outputs = dict()
+        # markers do not change between layers, see _build_markers
+        self._max_marker_label = None
 
         self.LCN = LIDSConvNet(
             remove_boder=remove_border,
@@ -301,16 +347,8 @@ class LCNCreator:
 
         architecture = self._architecture
         images = self._images
-        markers = self._markers
+        markers = self._build_markers()
 
-        if self._relabel_markers and markers is not None:
-            start_label = 2 if self._has_superpixel_markers else 1
-            markers = label_connected_components(
-                markers, start_label, is_3d=markers.ndim == 4
-            )
-
-        if self._has_superpixel_markers:
-            markers += self._superpixel_markers
         input_shape = self._input_shape
         # if len(input_shape) == 1:
         #    input_shape = [0, 0, *input_shape]
@@ -335,9 +373,6 @@ class LCNCreator:
 
             self.LCN.add_module(module_name, module)
 
-        # TODO is it necessary to empty cuda memory?
-        torch.cuda.empty_cache()
-
     def build_feature_extractor(
         self, remove_similar_filters=False, similarity_level=0.85
     ):
@@ -367,19 +402,7 @@ class LCNCreator:
 
         architecture = self._architecture
         images = self._images
-        markers = self._markers
-
-        if "input" in self._to_save_outputs:
-            self._outputs["input"] = images
-
-        if self._relabel_markers and markers is not None:
-            start_label = 2 if self._has_superpixel_markers else 1
-            markers = label_connected_components(
-                markers, start_label, is_3d=markers.ndim == 4
-            )
-
-        if self._has_superpixel_markers:
-            markers += self._superpixel_markers
+        markers = self._build_markers()
 
         module, out_channels, _, _ = self._build_module(
             None,
@@ -394,7 +417,56 @@ class LCNCreator:
 
         self.LCN.feature_extractor = module
 
-        torch.cuda.empty_cache()
+    def release_cache(self):
+        """Release the GPU memory cached by PyTorch.
+
+        Building a model leaves the memory of its activations cached by \
+        the PyTorch allocator, which reuses it for later allocations, \
+        e.g. while training the model. Only call it when that memory is \
+        needed by other processes, as the next allocations are slower.
+
+        """
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _compile(self, layer):
+        """Get the function that runs `layer` over the batches of images.
+
+        With ``compile_layers``, on CUDA the layer is compiled with \
+        ``torch.compile``, which fuses its element-wise operations \
+        and replays the batches with CUDA graphs.
+
+        """
+        if self._compile_layers and torch.device(self.device).type == "cuda":
+            return torch.compile(layer, mode="reduce-overhead")
+
+        return layer.forward
+
+    def _build_markers(self):
+        """Get the markers used by all layers of a build.
+
+        The markers are relabeled and merged with the superpixel \
+        markers once, before the layers are built, and never change \
+        between layers. The creator's markers are not modified, \
+        so the model can be built again.
+
+        """
+        markers = self._markers
+
+        if self._relabel_markers and markers is not None:
+            start_label = 2 if self._has_superpixel_markers else 1
+            markers = label_connected_components(
+                markers, start_label, is_3d=markers.ndim == 4
+            )
+
+        if self._has_superpixel_markers:
+            markers = markers + self._superpixel_markers
+
+        # computed once per build instead of once per conv layer
+        if markers is not None:
+            self._max_marker_label = int(markers.max())
+
+        return markers
 
     def load_model(self, state_dict):
         architecture = self._architecture
@@ -518,18 +590,9 @@ class LCNCreator:
                     # check if there is a pool operation with stride > 1 before convolution
                     dilation_due_to_pool = 1
                     if operation_params.get("train_dilation", False) is True:
-                        for node in self._digraph.dfs_from_vertex(
+                        dilation_due_to_pool = self._digraph.dilation_due_to_pool(
                             module_name + "." + key
-                        ):
-                            if (
-                                not node.is_module
-                                and node.arch
-                                and "pool" in node.arch["operation"]
-                            ):
-                                if node.arch["params"]["stride"] > 1:
-                                    dilation_due_to_pool *= node.arch["params"][
-                                        "stride"
-                                    ]
+                        )
 
                     original_dilation = operation_params.get("dilation", 1)
                     layer_config["params"]["dilation"] = (
@@ -588,6 +651,9 @@ class LCNCreator:
                     is_3d = layer_config["operation"] == "conv3d"
                     end = 3 if is_3d else 2
 
+                    # the same memory format as the inputs of _to_chw_tensor
+                    layer = layer.to(memory_format=_memory_format(is_3d))
+
                     # chage dilation to original value
                     layer_config["params"]["dilation"] = original_dilation
 
@@ -689,20 +755,16 @@ class LCNCreator:
 
                     layer.train()
                     layer = layer.to(device)
-                    is_3d = "3d" in layer_config["operation"]
                     if images is not None and markers is not None:
-                        torch_images = torch.Tensor(images)
-
-                        if is_3d:
-                            torch_images = torch_images.permute(0, 4, 3, 1, 2)
-                        else:
-                            torch_images = torch_images.permute(0, 3, 1, 2)
+                        torch_images = _to_chw_tensor(images, device)
 
                         input_size = torch_images.size(0)
 
-                        for i in range(0, input_size, batch_size):
-                            batch = torch_images[i : i + batch_size]
-                            output = layer.forward(batch.to(device))
+                        # the running statistics are still updated in place
+                        with torch.inference_mode():
+                            for i in range(0, input_size, batch_size):
+                                batch = torch_images[i : i + batch_size]
+                                output = layer.forward(batch)
 
                     layer.eval()
 
@@ -712,24 +774,9 @@ class LCNCreator:
                     or layer_config["operation"] == "max_pool3d"
                     or layer_config["operation"] == "avg_pool3d"
                 ):
-                    dilation_due_to_pool = 1
-                    if operation_params.get("train_dilation", False) is True:
-                        for node in self._digraph.dfs_from_vertex(
-                            module_name + "." + key
-                        ):
-                            if (
-                                not node.is_module
-                                and node.arch
-                                and "pool" in node.arch["operation"]
-                            ):
-                                if node.arch["params"]["stride"] > 1:
-                                    dilation_due_to_pool *= node.arch["params"][
-                                        "stride"
-                                    ]
-
-                    layer, _ = self._build_pool_layer(
-                        images, markers, batch_size, layer_config, dilation_due_to_pool
-                    )
+                    # the images are not pooled, the next layers are
+                    # dilated instead, so the pool has nothing to compute
+                    layer = self._build_pool_layer(layer_config)
 
                     is_3d = "3d" in layer_config["operation"]
                     end = 3 if is_3d else 2
@@ -770,21 +817,11 @@ class LCNCreator:
 
                 elif layer_config["operation"] == "unfold":
                     # TODO support 3D images?
-                    kernel_size = operation_params["kernel_size"]
-                    stride = operation_params.get("stride", 1)
-                    padding = operation_params.get("padding", 0)
-                    dilation = operation_params.get("dilation", 1)
-
                     is_3d = len(input_shape) == 4
 
-                    if isinstance(kernel_size, int):
-                        kernel_size = np.array([kernel_size] * (3 if is_3d else 2))
-                    if isinstance(stride, int):
-                        stride = np.array([stride] * (3 if is_3d else 2))
-                    if isinstance(padding, int):
-                        padding = np.array([padding] * (3 if is_3d else 2))
-                    if isinstance(dilation, int):
-                        dilation = np.array([dilation] * (3 if is_3d else 2))
+                    kernel_size, stride, padding, dilation = map(
+                        np.array, _normalize_spatial(operation_params, is_3d)
+                    )
 
                     layer = operation(**operation_params)
                     _layer_output_shape = [*input_shape]
@@ -815,7 +852,10 @@ class LCNCreator:
                             "FLIM decoder does not currently support 3D images."
                         )
                     layer = operation(
-                        images, self._markers, device=device, **operation_params
+                        _to_hwc_array(images),
+                        self._markers,
+                        device=device,
+                        **operation_params,
                     )
                     layer.to(device)
 
@@ -839,12 +879,7 @@ class LCNCreator:
                     _layer_output_shape = [*input_shape]
 
                 if images is not None and markers is not None:
-                    torch_images = torch.Tensor(images)
-                    is_3d = torch_images.ndim == 5
-                    if is_3d:
-                        torch_images = torch_images.permute(0, 4, 3, 1, 2)
-                    else:
-                        torch_images = torch_images.permute(0, 3, 1, 2)
+                    torch_images = _to_chw_tensor(images, device)
 
                     input_size = torch_images.size(0)
 
@@ -852,19 +887,23 @@ class LCNCreator:
                         layer_config["operation"] != "unfold"
                         and not ("pool" in layer_config["operation"])
                         and not ("linear" in layer_config["operation"])
+                        and layer_config["operation"] not in _IDENTITY_OPERATIONS
                     ):
-                        outputs = torch.Tensor([])
+                        outputs = None
                         layer = layer.to(self.device)
+                        layer_forward = self._compile(layer)
 
-                        for i in range(0, input_size, batch_size):
-                            batch = torch_images[i : i + batch_size]
-                            output = layer.forward(batch.to(device))
-                            output = output.detach().cpu()
-                            outputs = torch.cat((outputs, output))
-                        if is_3d:
-                            images = outputs.permute(0, 3, 4, 2, 1).detach().numpy()
-                        else:
-                            images = outputs.permute(0, 2, 3, 1).detach().numpy()
+                        with torch.inference_mode():
+                            for i in range(0, input_size, batch_size):
+                                batch = torch_images[i : i + batch_size]
+                                output = layer_forward(batch)
+                                if outputs is None:
+                                    outputs = _empty_outputs(input_size, output)
+                                outputs[i : i + batch_size].copy_(output)
+
+                        # free the inputs before the next layer is initialized
+                        images = outputs
+                        del torch_images
 
                         # _layer_output_shape = list(images.shape[1:])
                 layer.train()
@@ -890,90 +929,24 @@ class LCNCreator:
                     module_output_shape[2] -= 2 * self._remove_border
         return module, module_output_shape, images, markers
 
-    def _build_pool_layer(
-        self, images, markers, batch_size, layer_config, dilation_due_to_pool
-    ):
-        device = self.device
-        f_operations = {
-            "max_pool2d": F.max_pool2d,
-            "max_pool3d": F.max_pool3d,
-            "avg_pool2d": F.avg_pool2d,
-            "avg_pool3d": F.avg_pool3d,
-        }
+    def _build_pool_layer(self, layer_config):
         operation_name = layer_config["operation"]
         operation_params = layer_config["params"]
         operation = __operations__[operation_name]
-        f_pool = f_operations[operation_name]
-        original_dilation = operation_params.get("dilation", 1)
 
         is_3d = "3d" in operation_name
 
         stride = operation_params.get("stride", 1)
-        kernel_size = operation_params["kernel_size"]
-        padding = operation_params.get("padding", 0)
-        dilation = dilation_due_to_pool * original_dilation
-
-        if isinstance(padding, int):
-            padding = [padding] * (3 if is_3d else 2)
-
-        if isinstance(kernel_size, int):
-            kernel_size = [kernel_size] * (3 if is_3d else 2)
-
-        operation_params["stride"] = 1
-        operation_params["dilation"] = dilation_due_to_pool
-        # TODO what about dilation?
-        # operation_params["padding"] = [k_size // 2 for k_size in kernel_size]
-        if images is not None and markers is not None:
-            torch_images = torch.from_numpy(images)
-
-            if is_3d:
-                torch_images = torch_images.permute(0, 4, 3, 1, 2)
-            else:
-                torch_images = torch_images.permute(0, 3, 1, 2)
-
-            input_shape = torch_images.shape
-            input_size = input_shape[0]
-
-            outputs = torch.Tensor([])
-
-            # temporarly ignore warnings till pytorch is fixed
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                with torch.no_grad():
-                    for i in range(0, input_size, batch_size):
-                        batch = torch_images[i : i + batch_size]
-                        batch = batch.to(device)
-                        output = f_pool(
-                            batch,
-                            kernel_size=kernel_size,
-                            stride=stride,
-                            padding=padding,
-                            dilation=dilation,
-                        )
-                        output = output.detach().cpu()
-                        outputs = torch.cat((outputs, output))
-
-            if is_3d:
-                images = (
-                    outputs.permute(0, 3, 4, 2, 1)
-                    .detach()
-                    .numpy()[:, :, : input_shape[2], : input_shape[3], : input_shape[3]]
-                )
-            else:
-                images = (
-                    outputs.permute(0, 2, 3, 1)
-                    .detach()
-                    .numpy()[:, :, : input_shape[2], : input_shape[3]]
-                )
+        kernel_size, _, padding, _ = _normalize_spatial(operation_params, is_3d)
+        dilation = operation_params.get("dilation", 1)
 
         operation_params["stride"] = stride
         operation_params["padding"] = padding
-        operation_params["dilation"] = original_dilation
-        dilation = original_dilation
+        operation_params["dilation"] = dilation
         layer = operation(
             kernel_size=kernel_size, stride=stride, padding=padding, dilation=dilation
         )
-        return layer, images
+        return layer
 
     def _build_m_norm_layer(self, images, markers, input_shape, layer_config):
         operation_name = layer_config["operation"]
@@ -989,35 +962,30 @@ class LCNCreator:
             std = None
             epsilon = 0.001
         else:
-            kernel_size = 1
-            dilation = 1
             epsilon = operation_params.get("epsilon", 0.001)
 
-            if isinstance(dilation, int):
-                dilation = [dilation] * (3 if is_3d else 2)
-
-            if isinstance(kernel_size, int):
-                kernel_size = [kernel_size] * (3 if is_3d else 2)
-
-            patches, _ = _generate_patches(
-                images, markers, in_channels, kernel_size, dilation
-            )
+            kernel_size, _, _, dilation = _normalize_spatial({"kernel_size": 1}, is_3d)
 
             if is_3d:
                 axis = (0, 1, 2, 3)
             else:
                 axis = (0, 1, 2)
 
-            mean = (
-                torch.from_numpy(patches.mean(axis=axis, keepdims=True))
-                .flatten()
-                .float()
-            )
-            std = (
-                torch.from_numpy(patches.std(axis=axis, keepdims=True))
-                .flatten()
-                .float()
-            )
+            if torch.device(self.device).type == "cuda":
+                patches, _ = _generate_patches_on_device(
+                    _to_hwc(images), markers, kernel_size, dilation, self.device
+                )
+                std, mean = torch.std_mean(patches, dim=axis, correction=0)
+                mean, std = mean.float(), std.float()
+
+            else:
+                patches, _ = _generate_patches(
+                    _to_hwc_array(images), markers, in_channels, kernel_size, dilation
+                )
+
+                mean, std = _channel_mean_std(patches.reshape(-1, in_channels))
+                mean = torch.from_numpy(mean).float()
+                std = torch.from_numpy(std).float()
 
         layer = operation(mean=mean, std=std, in_channels=in_channels, epsilon=epsilon)
 
@@ -1046,12 +1014,11 @@ class LCNCreator:
 
         use_pca = operation_params.get("use_pca", True)
 
-        kernel_size = operation_params["kernel_size"]
-        stride = operation_params.get("stride", 1)
         # TODO check padding is enough to maintain the input size
-        padding = operation_params.get("padding", 0)
+        kernel_size, stride, padding, dilation = _normalize_spatial(
+            operation_params, is_3d
+        )
         padding_mode = operation_params.get("padding_mode", "zeros")
-        dilation = operation_params.get("dilation", 1)
         groups = operation_params.get("groups", 1)
         bias = operation_params.get("bias", False)
 
@@ -1066,26 +1033,18 @@ class LCNCreator:
         ), "`out_channels` or `markers` must be defined."
 
         in_channels = input_shape[-1]
-        if isinstance(dilation, int):
-            dilation = [dilation] * (3 if is_3d else 2)
-
-        if isinstance(padding, int):
-            padding = [padding] * (3 if is_3d else 2)
-
-        if isinstance(kernel_size, int):
-            kernel_size = [kernel_size] * (3 if is_3d else 2)
 
         if (
             markers is not None
             and "number_of_kernels_per_marker" not in operation_params
         ):
             number_of_kernels_per_marker = math.ceil(
-                operation_params["out_channels"] / np.array(markers).max()
+                operation_params["out_channels"] / self._max_marker_label
             )
 
         if out_channels is not None:
             assert out_channels is not None or (
-                number_of_kernels_per_marker * np.array(markers).max() >= out_channels
+                number_of_kernels_per_marker * self._max_marker_label >= out_channels
             ), f"The number of kernels per marker is not enough to generate {out_channels} kernels."
 
         weights, bias_weights = _initialize_convNd_weights(
@@ -1179,16 +1138,21 @@ def _prepare_markers(markers):
         and the third row is the markers pixel labels.
 
     """
-    _markers = []
-    for m in markers:
-        indices = np.where(m != 0)
+    markers = np.asarray(markers)
+    mask = markers != 0
+
+    # a single scan for the markers pixels of all images,
+    # in the same order as np.where on each image
+    coords = np.argwhere(mask)
+    labels = markers[mask]
 
-        max_label = m.max()
-        labels = m[indices] - 1 if max_label > 1 else m[indices]
+    counts = mask.reshape(markers.shape[0], -1).sum(axis=1)
+    max_labels = markers.reshape(markers.shape[0], -1).max(axis=1)
+    labels = labels - (max_labels > 1).repeat(counts).astype(labels.dtype)
 
-        _markers.append([indices[0], indices[1], labels])
+    markers_by_image = np.stack([coords[:, 1], coords[:, 2], labels])
 
-    return _markers
+    return np.split(markers_by_image, np.cumsum(counts)[:-1], axis=1)
 
 
 def _assert_params(params):
@@ -1218,56 +1182,59 @@ def _assert_params(params):
 
 
 def _pooling_markers(markers, kernel_size, stride=1, padding=0):
-    new_markers = []
-    for marker in markers:
-        indices_x, indices_y = np.where(marker != 0)
+    kernel_size, stride, padding, _ = _normalize_spatial(
+        {"kernel_size": kernel_size, "stride": stride, "padding": padding}, False
+    )
 
-        marker_shape = [*marker.shape]
+    markers_shape = markers[0].shape
+    new_markers_shape = [
+        (markers_shape[axis] + 2 * padding[axis] - kernel_size[axis]) // stride[axis]
+        + 1
+        for axis in range(2)
+    ]
+    new_markers = np.zeros((len(markers), *new_markers_shape), dtype=np.int32)
 
-        marker_shape[0] = math.floor(
-            (marker_shape[0] + 2 * padding[0] - kernel_size[0]) / stride + 1
-        )
-        marker_shape[1] = math.floor(
-            (marker_shape[1] + 2 * padding[1] - kernel_size[1]) / stride + 1
-        )
+    x_limit = markers_shape[0] + 2 * padding[0] - kernel_size[0]
+    y_limit = markers_shape[1] + 2 * padding[1] - kernel_size[1]
+    for marker, new_marker in zip(markers, new_markers):
+        indices_x, indices_y = np.nonzero(marker)
 
-        new_marker = np.zeros(marker_shape, dtype=np.int32)
-        x_limit = marker.shape[0] + 2 * padding[0] - kernel_size[0]
-        y_limit = marker.shape[1] + 2 * padding[1] - kernel_size[1]
-        for x, y in zip(indices_x, indices_y):
-            if x > x_limit or y > y_limit:
-                continue
-            new_marker[x // stride][y // stride] = marker[x][y]
+        inside = (indices_x <= x_limit) & (indices_y <= y_limit)
+        indices_x, indices_y = indices_x[inside], indices_y[inside]
 
-        new_markers.append(new_marker)
+        new_marker[indices_x // stride[0], indices_y // stride[1]] = marker[
+            indices_x, indices_y
+        ]
 
-    return np.array(new_markers)
+    return new_markers
 
 
-def _create_random_kernels(n, in_channels, kernel_size):
-    kernels = np.random.rand(n, in_channels, *kernel_size)
+def _create_random_kernels(n, in_channels, kernel_size, device="cpu"):
+    # created on the build device, where they are normalized and selected
+    kernels = torch.rand(n, in_channels, *kernel_size, device=device)
 
     return kernels
 
 
 def _enforce_norm(kernels):
-    kernels_shape = kernels.shape
-    flattened_kernels = kernels.reshape(kernels_shape[0], -1)
-
-    norm = np.linalg.norm(flattened_kernels, axis=1, keepdims=True)
-
-    normalized = flattened_kernels / norm
+    # a single float32 copy, normalized and centered in place
+    kernels = kernels.to(
+        torch.float32, memory_format=torch.contiguous_format, copy=True
+    )
+    flattened_kernels = kernels.view(kernels.shape[0], -1)
 
-    mean = normalized.mean(axis=1, keepdims=True)
+    norm = torch.linalg.vector_norm(flattened_kernels, dim=1, keepdim=True)
 
-    centered = normalized - mean
+    flattened_kernels /= norm
 
-    centered = centered.reshape(*kernels_shape)
+    flattened_kernels -= flattened_kernels.mean(dim=1, keepdim=True)
 
-    return centered
+    return kernels
 
 
-def _create_random_pca_kernels(n, k, in_channels, kernel_size, verbose=False):
+def _create_random_pca_kernels(
+    n, k, in_channels, kernel_size, device="cpu", verbose=False
+):
     if verbose:
         print("Creating random kernels with PCA...")
 
@@ -1276,14 +1243,18 @@ def _create_random_pca_kernels(n, k, in_channels, kernel_size, verbose=False):
     elif isinstance(kernel_size, list) and len(kernel_size) == 1:
         kernel_size = kernel_size * 2
 
-    kernels = _enforce_norm(_create_random_kernels(n, in_channels, kernel_size))
+    kernels = _enforce_norm(
+        _create_random_kernels(n, in_channels, kernel_size, device=device)
+    )
 
-    kernels_pca = _select_kernels_with_pca(kernels, k, verbose=verbose)
+    kernels_pca = _select_kernels_with_pca(kernels, k, device=device, verbose=verbose)
 
     return kernels_pca
 
 
-def _select_kernels_with_pca(kernels, k, scale_kernels=False, verbose=False):
+def _select_kernels_with_pca(
+    kernels, k, scale_kernels=False, device="cpu", verbose=False
+):
     if verbose:
         print("Selecting kernels with PCA...")
     kernels_shape = kernels.shape
@@ -1291,150 +1262,252 @@ def _select_kernels_with_pca(kernels, k, scale_kernels=False, verbose=False):
     if k > kernels_flatted.shape[0] or k > kernels_flatted.shape[1]:
         k = min(kernels_flatted.shape[0], kernels_flatted.shape[1])
 
-    pca = PCA(n_components=k)
-    pca.fit(kernels_flatted)
+    # the principal components of the kernels, as computed by sklearn's PCA
+    kernels_flatted = torch.as_tensor(
+        kernels_flatted, dtype=torch.float32, device=device
+    )
+    centered = kernels_flatted - kernels_flatted.mean(dim=0)
+
+    # as sklearn's "auto" solver, only large matrices with few components
+    # and many features get a randomized truncated SVD, the others are exact
+    n_samples, n_features = centered.shape
+    min_size = min(n_samples, n_features)
+    is_small = max(n_samples, n_features) <= 500 or (
+        n_features < 1000 and n_samples >= 10 * n_features
+    )
+    if not is_small and k < 0.8 * min_size:
+        fork_devices = [device] if torch.device(device).type == "cuda" else []
+        with torch.random.fork_rng(devices=fork_devices):
+            torch.manual_seed(0)
+            _, singular_values, components = torch.svd_lowrank(
+                centered,
+                q=min(k + 10, min_size),
+                niter=7 if k < 0.1 * min_size else 4,
+            )
+        components = components.T
+    else:
+        _, singular_values, components = torch.linalg.svd(centered, full_matrices=False)
+    components, singular_values = components[:k], singular_values[:k]
+
+    # the largest absolute value of each component is positive
+    max_abs_indices = components.abs().argmax(dim=1)
+    signs = torch.sign(components[torch.arange(k), max_abs_indices])
+    components = components * signs[:, None]
 
-    kernels_pca = pca.components_
     if scale_kernels:
-        eigen_values = pca.singular_values_
-        kernels_pca = kernels_pca * np.expand_dims(eigen_values, 1)
-    kernels_pca = kernels_pca.reshape(-1, *kernels_shape[1:])
+        components = components * singular_values[:, None]
+    kernels_pca = components.cpu().numpy().reshape(-1, *kernels_shape[1:])
 
     return kernels_pca
 
 
+@njit(parallel=True, cache=True)
+def _channel_sums_kernel(values, n_chunks, sums, squares):
+    n = values.shape[0]
+    for chunk in prange(n_chunks):
+        for i in range(chunk * n // n_chunks, (chunk + 1) * n // n_chunks):
+            for c in range(values.shape[1]):
+                value = values[i, c]
+                sums[chunk, c] += value
+                squares[chunk, c] += value * value
+
+
+def _channel_mean_std(values):
+    """Compute the mean and standard deviation of each channel.
+
+    Both are computed in a single parallel pass over `values`, \
+    with float64 sums of the values and of their squares.
+
+    Parameters
+    ----------
+    values : ndarray
+        Array with shape :math:`(M, C)`.
+
+    Returns
+    -------
+    tuple[ndarray, ndarray]
+        The float64 mean and standard deviation of each channel.
+
+    """
+    n_chunks = max(1, min(64, values.shape[0]))
+    sums = np.zeros((n_chunks, values.shape[1]))
+    squares = np.zeros((n_chunks, values.shape[1]))
+
+    _channel_sums_kernel(values, n_chunks, sums, squares)
+
+    mean = sums.sum(axis=0) / values.shape[0]
+    variance = squares.sum(axis=0) / values.shape[0] - mean**2
+
+    return mean, np.sqrt(np.maximum(variance, 0))
+
+
+@njit(parallel=True, cache=True)
+def _gather_patches_2d(images, coords, dilation, padding, out):
+    height, width = images.shape[1], images.shape[2]
+    for m in prange(coords.shape[0]):
+        n = coords[m, 0]
+        for i in range(out.shape[1]):
+            x = coords[m, 1] + i * dilation[0] - padding[0]
+            for j in range(out.shape[2]):
+                y = coords[m, 2] + j * dilation[1] - padding[1]
+                inside = 0 <= x < height and 0 <= y < width
+                for c in range(out.shape[3]):
+                    out[m, i, j, c] = images[n, x, y, c] if inside else 0
+
+
+@njit(parallel=True, cache=True)
+def _gather_patches_3d(images, coords, dilation, padding, out):
+    height, width, depth = images.shape[1], images.shape[2], images.shape[3]
+    for m in prange(coords.shape[0]):
+        n = coords[m, 0]
+        for i in range(out.shape[1]):
+            x = coords[m, 1] + i * dilation[0] - padding[0]
+            for j in range(out.shape[2]):
+                y = coords[m, 2] + j * dilation[1] - padding[1]
+                for k in range(out.shape[3]):
+                    z = coords[m, 3] + k * dilation[2] - padding[2]
+                    inside = 0 <= x < height and 0 <= y < width and 0 <= z < depth
+                    for c in range(out.shape[4]):
+                        out[m, i, j, k, c] = images[n, x, y, z, c] if inside else 0
+
+
 def _generate_patches(
     images, markers, in_channels, kernel_size, dilation, verbose=False
 ):
     """Get patches from markers pixels.
 
-        Get a patch of size :math:`k \times k` around each markers pixel.
-        
-        ----------
-        images : ndarray
-            Array of images with shape :math:`(N, H, W, C)`.
-        markers : list
-            List of markers. For each image there is an ndarry with shape \
-            :math:`3 \times N` where :math:`N` is the number of markers pixels.
-            The first row is the markers pixels :math:`x`-coordinates, \
-            second row is the markers pixels :math:`y`-coordinates, \
-            and the third row is the markers pixel labels.
-        in_channels : int
-            The input channel number.
-        kernel_size : int, optional
-            The kernel dimensions. \
-            If a single number :math:`k` if provided, it will be interpreted \
-            as a kernel :math:`k \times k`, by default 3.
-        padding : int, optional
-            The number of zeros to add to pad, by default 1.
+    Get a patch of size :math:`k_1 \times k_2` (or \
+    :math:`k_1 \times k_2 \times k_3`) around each markers pixel. \
+    The dilated kernel is read directly from the images, \
+    with zeros outside them, so no padded copy or window view is created.
 
-        Returns
-        -------
-        tuple[ndarray, ndarray]
-            A array with all genereated pacthes and \
-            an array with the label of each patch.
-        
-        """
+    Parameters
+    ----------
+    images : ndarray
+        Array of images with shape :math:`(N, H, W, C)` \
+        or :math:`(N, H, W, D, C)`.
+    markers : ndarray
+        A set of image markes as label images with size :math:`(N, H, W)` \
+        or :math:`(N, H, W, D)`. The label 0 denote no label.
+    in_channels : int
+        The input channel number.
+    kernel_size : list
+        The kernel dimensions.
+    dilation : list
+        The kernel dilation.
+
+    Returns
+    -------
+    tuple[ndarray, ndarray]
+        A float32 array with all genereated pacthes, with shape \
+        :math:`(M, k_1, ..., k_n, C)`, and an array with the label of each patch.
+
+    """
     kernel_size = np.array(kernel_size)
     dilation = np.array(dilation)
 
     dilated_kernel_size = kernel_size + (dilation - 1) * (kernel_size - 1)
     dilated_padding = dilated_kernel_size // 2
 
-    is_2d = kernel_size.shape[0] == 2
+    images = np.asarray(images)
+    spatial_shape = images.shape[1:-1]
 
-    if is_2d:
-        padding = (
-            (dilated_padding[0], dilated_padding[0]),
-            (dilated_padding[1], dilated_padding[1]),
-            (0, 0),
-        )
-        patches_shape = (dilated_kernel_size[0], dilated_kernel_size[1], in_channels)
-    else:
-        padding = (
-            (dilated_padding[0], dilated_padding[0]),
-            (dilated_padding[1], dilated_padding[1]),
-            (dilated_padding[2], dilated_padding[2]),
-            (0, 0),
-        )
-        patches_shape = (
-            dilated_kernel_size[0],
-            dilated_kernel_size[1],
-            dilated_kernel_size[2],
-            in_channels,
-        )
+    # markers out of the images are ignored
+    markers = np.asarray(markers)[
+        (slice(None), *(slice(0, size) for size in spatial_shape))
+    ]
 
-    all_patches, all_labels = None, None
-    for image, image_markers in zip(images, markers):
-        if len(image_markers) == 0:
-            continue
+    indices = np.nonzero(markers)
+    labels = markers[indices] - 1
+    coords = np.stack(indices, axis=1)
 
-        image_pad = np.pad(image, padding, mode="constant", constant_values=0)
-        # TODO check if patches_shape is valid
-        patches = view_as_windows(image_pad, patches_shape, step=1)
+    # float32 for any image dtype, as the patches gathered on the device
+    patches = np.empty(
+        (coords.shape[0], *kernel_size, images.shape[-1]), dtype=np.float32
+    )
 
-        shape = patches.shape
-        image_shape = image.shape
+    if kernel_size.shape[0] == 2:
+        _gather_patches_2d(images, coords, dilation, dilated_padding, patches)
+    else:
+        _gather_patches_3d(images, coords, dilation, dilated_padding, patches)
 
-        indices = np.where(image_markers != 0)
-        markers_x = indices[0]
-        markers_y = indices[1]
-        if not is_2d:
-            markers_z = indices[1]
-        labels = image_markers[indices] - 1
+    return patches, labels
 
-        mask = np.logical_and(markers_x < image_shape[0], markers_y < image_shape[1])
 
-        if not is_2d:
-            mask = np.logical_and(mask, markers_z < image_shape[2])
-            markers_z = markers_z[mask]
+def _generate_patches_on_device(images, markers, kernel_size, dilation, device):
+    """Get patches from markers pixels on `device`.
 
-        markers_x = markers_x[mask]
-        markers_y = markers_y[mask]
+    The same patches as :func:`_generate_patches`, gathered \
+    from the images with a single indexing operation.
 
-        labels = labels[mask]
+    Parameters
+    ----------
+    images : ndarray
+        Array of images with shape :math:`(N, H, W, C)` \
+        or :math:`(N, H, W, D, C)`.
+    markers : ndarray
+        A set of image markes as label images with size :math:`(N, H, W)` \
+        or :math:`(N, H, W, D)`. The label 0 denote no label.
+    kernel_size : list
+        The kernel dimensions.
+    dilation : list
+        The kernel dilation.
+    device : str
+        Device where the patches are gathered.
 
-        if is_2d:
-            generated_patches = patches[markers_x, markers_y].reshape(-1, *shape[3:])
-        else:
-            generated_patches = patches[markers_x, markers_y, markers_z].reshape(
-                -1, *shape[4:]
-            )
+    Returns
+    -------
+    tuple[torch.Tensor, torch.Tensor]
+        A tensor with all generated patches, with shape \
+        :math:`(M, k_1, ..., k_n, C)`, and a tensor with the label of each patch.
 
-        if is_2d:
-            if dilation[0] > 1 or dilation[1] > 1:
-                r = np.arange(0, dilated_kernel_size[0], dilation[0])
-                s = np.arange(0, dilated_kernel_size[1], dilation[1])
-                generated_patches = generated_patches[:, r, :, :][:, :, s, :]
-        else:
-            if dilation[0] > 1 or dilation[1] > 1 or dilation[2] > 1:
-                r = np.arange(0, dilated_kernel_size[0], dilation[0])
-                s = np.arange(0, dilated_kernel_size[1], dilation[1])
-                t = np.arange(0, dilated_kernel_size[2], dilation[2])
-                generated_patches = generated_patches[:, r, :, :, :][:, :, s, :, :][
-                    :, :, :, t, :
-                ]
-
-        if all_patches is None:
-            all_patches = generated_patches
-            all_labels = labels
-        else:
-            all_patches = np.concatenate((all_patches, generated_patches))
-            all_labels = np.concatenate((all_labels, labels))
+    """
+    kernel_size = np.array(kernel_size)
+    dilation = np.array(dilation)
 
-    return all_patches, all_labels
+    dilated_kernel_size = kernel_size + (dilation - 1) * (kernel_size - 1)
+    dilated_padding = dilated_kernel_size // 2
 
+    torch_images = torch.as_tensor(images, dtype=torch.float32, device=device)
+    spatial_shape = torch_images.shape[1:-1]
+
+    # markers out of the images are ignored
+    torch_markers = torch.as_tensor(markers, device=device)[
+        (slice(None), *(slice(0, size) for size in spatial_shape))
+    ]
+
+    indices = torch.nonzero(torch_markers)
+    labels = torch_markers[tuple(indices.T)] - 1
+
+    # the patches are read from the images with clamped indices, and the
+    # pixels out of the images are zeroed, so no padded copy is created
+    n_dims = len(kernel_size)
+    image_index = indices[:, 0].view(-1, *[1] * n_dims)
+    spatial_indices = []
+    inside = torch.ones((1,) * (n_dims + 1), dtype=torch.bool, device=device)
+    for axis in range(n_dims):
+        offsets = torch.arange(kernel_size[axis], device=device) * dilation[axis]
+        shape = [1] * n_dims
+        shape[axis] = -1
+        axis_indices = (
+            indices[:, axis + 1].view(-1, *[1] * n_dims)
+            + offsets.view(shape)
+            - int(dilated_padding[axis])
+        )
+        inside = inside & (axis_indices >= 0) & (axis_indices < spatial_shape[axis])
+        spatial_indices.append(axis_indices.clamp(0, spatial_shape[axis] - 1))
 
-def _points_closest_to_centers(points, centers):
-    _points = []
-    for center in centers:
-        _center = np.expand_dims(center, 0)
+    patches = torch_images[(image_index, *spatial_indices)]
+    patches.masked_fill_(~inside.unsqueeze(-1), 0)
 
-        dist = distance.cdist(points, _center)
+    return patches, labels
 
-        _points.append(points[np.argmin(dist)])
 
-    return np.array(_points)
+def _points_closest_to_centers(points, centers):
+    # the distances to all centers with a single call
+    dist = distance.cdist(points, centers)
+
+    return points[np.argmin(dist, axis=0)]
 
 
 def _find_elems_in_array(a, elems):
@@ -1480,27 +1553,42 @@ def _kmeans_roots(
     """
     if verbose:
         print("Clustering...")
-    roots = None
+    roots = []
     min_number_of_pacthes_per_label = n_clusters_per_label
 
-    possible_labels = np.unique(labels)
+    # a single stable sort puts the patches of each label in a contiguous
+    # block, in their original order, instead of a mask per label
+    order = np.argsort(labels, kind="stable")
+    _, label_starts = np.unique(labels[order], return_index=True)
+    sorted_patches = patches[order].astype(np.float32, copy=False)
+
     cluster_labels = np.zeros_like(labels)
     last_label = 0
-    for i, label in enumerate(possible_labels):
-        patches_of_label = patches[label == labels].astype(np.float32)
+    for patches_of_label, indices_of_label in zip(
+        np.split(sorted_patches, label_starts[1:]), np.split(order, label_starts[1:])
+    ):
         # TODO get a value as arg.
         if patches_of_label.shape[0] > min_number_of_pacthes_per_label:
             # TODO remove fix random_state
-            # kmeans = MiniBatchKMeans(
-            #    n_clusters=n_clusters_per_label, max_iter=300, random_state=42, init_size=3 * n_clusters_per_label)
-
-            kmeans = KMeans(
-                n_clusters=n_clusters_per_label,
-                max_iter=100,
-                tol=0.001,
-                random_state=42,
-                n_init=10,
-            )
+            # as in _fit_kmeans, only large labels are approximated
+            if patches_of_label.shape[0] < _MIN_PATCHES_FOR_FAST_KMEANS:
+                kmeans = KMeans(
+                    n_clusters=n_clusters_per_label,
+                    max_iter=100,
+                    tol=0.001,
+                    random_state=42,
+                    n_init=10,
+                )
+            else:
+                kmeans = MiniBatchKMeans(
+                    n_clusters=n_clusters_per_label,
+                    batch_size=min(1024, patches_of_label.shape[0]),
+                    max_iter=100,
+                    tol=0.001,
+                    random_state=42,
+                    n_init=1,
+                    reassignment_ratio=0.0,
+                )
 
             if distance_metric == "cosine":
 
@@ -1513,7 +1601,7 @@ def _kmeans_roots(
             kmeans.fit(patches_of_label.reshape(patches_of_label.shape[0], -1))
             centers = kmeans.cluster_centers_
             current_labels = kmeans.labels_ + last_label
-            cluster_labels[label == labels] = current_labels
+            cluster_labels[indices_of_label] = current_labels
             last_label = current_labels.max() + 1
 
             kmeans.euclidean_distances = euclidean_distances
@@ -1528,15 +1616,13 @@ def _kmeans_roots(
         else:
             roots_of_label = patches_of_label.reshape(patches_of_label.shape[0], -1)
             current_labels = np.arange(roots_of_label.shape[0]) + last_label
-            cluster_labels[label == labels] = current_labels
+            cluster_labels[indices_of_label] = current_labels
             last_label = current_labels.max() + 1
 
-        if roots is not None:
-            roots = np.concatenate((roots, roots_of_label))
-        else:
-            roots = roots_of_label
+        roots.append(roots_of_label)
 
-    roots = roots.reshape(-1, *patches.shape[1:])
+    # a single copy, instead of one growing concatenation per label
+    roots = np.concatenate(roots).reshape(-1, *patches.shape[1:])
 
     if return_labels:
         return roots, cluster_labels
@@ -1544,6 +1630,62 @@ def _kmeans_roots(
     return roots
 
 
+# from this number of patches on, the k-means is approximated
+_MIN_PATCHES_FOR_FAST_KMEANS = 10000
+
+
+def _fit_kmeans(data, n_clusters):
+    """Cluster `data` with k-means.
+
+    Small sets are clustered with ``KMeans``. Large sets, with at least \
+    ``_MIN_PATCHES_FOR_FAST_KMEANS`` points, are clustered with faiss, \
+    on the GPU if faiss has GPU support, or with ``MiniBatchKMeans`` \
+    if faiss is not installed.
+
+    Parameters
+    ----------
+    data : ndarray
+        Points with shape :math:`(N, D)`.
+    n_clusters : int
+        The number of clusters.
+
+    Returns
+    -------
+    tuple[ndarray, ndarray]
+        The float32 cluster centers with shape :math:`(K, D)` \
+        and the cluster of each point.
+
+    """
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    n_samples = data.shape[0]
+
+    if n_samples < _MIN_PATCHES_FOR_FAST_KMEANS:
+        kmeans = KMeans(n_clusters=n_clusters, max_iter=100, tol=0.001, random_state=42)
+    elif faiss is not None:
+        kmeans = faiss.Kmeans(
+            data.shape[1],
+            n_clusters,
+            niter=20,
+            seed=42,
+            gpu=faiss.get_num_gpus() > 0,
+        )
+        kmeans.train(data)
+        _, labels = kmeans.index.search(data, 1)
+        return kmeans.centroids, labels[:, 0]
+    else:
+        kmeans = MiniBatchKMeans(
+            n_clusters=n_clusters,
+            batch_size=min(4096, n_samples),
+            max_iter=50,
+            n_init=3,
+            random_state=42,
+        )
+
+    kmeans.fit(data)
+
+    return kmeans.cluster_centers_.astype(np.float32, copy=False), kmeans.labels_
+
+
 def _calculate_convNd_weights(
     images,
     markers,
@@ -1581,9 +1723,15 @@ def _calculate_convNd_weights(
             :math:`(N \times C \times H \times W)`.
         
         """
-    patches, labels = _generate_patches(
-        images, markers, in_channels, kernel_size, dilation
-    )
+    if torch.device(device).type == "cuda":
+        patches, labels = _generate_patches_on_device(
+            _to_hwc(images), markers, kernel_size, dilation, device
+        )
+        patches, labels = patches.cpu().numpy(), labels.cpu().numpy()
+    else:
+        patches, labels = _generate_patches(
+            _to_hwc_array(images), markers, in_channels, kernel_size, dilation
+        )
 
     axis = tuple(range(len(kernel_size) + 1))
 
@@ -1668,7 +1816,9 @@ def _compute_kernels_with_backpropagation(
             kernels = kernels.reshape(-1, *kernel_shape)
             kernels = force_norm_1(kernels)
             kernels = _kernels_to_channel_first(kernels)
-            kernels = _select_kernels_with_pca(kernels, num_kernels, verbose=verbose)
+            kernels = _select_kernels_with_pca(
+                kernels, num_kernels, device=device, verbose=verbose
+            )
             bias = np.zeros(num_kernels, dtype=np.float32)
             kernels = _kernels_to_channel_last(kernels)
             # TODO do not return form here
@@ -1696,12 +1846,7 @@ def _compute_kernels_with_backpropagation(
         init_kernels = new_cluster_centers
 
     else:
-        kmeans = KMeans(
-            n_clusters=num_kernels, max_iter=100, tol=0.001, random_state=42
-        )
-        kmeans.fit(patches)
-        labels = kmeans.labels_
-        init_kernels = kmeans.cluster_centers_
+        init_kernels, labels = _fit_kmeans(patches, num_kernels)
 
     lin_layer = nn.Linear(patches.shape[1], num_kernels, bias=True).to(device)
     act_layer = nn.ReLU(True).to(device)
@@ -1797,6 +1942,7 @@ def _initialize_convNd_weights(
             k=out_channels,
             in_channels=in_channels,
             kernel_size=kernel_size,
+            device=device,
         )
 
     elif images is not None and markers is not None:
@@ -1841,7 +1987,7 @@ def _initialize_convNd_weights(
                 and (np.prod(kernels_weights.shape[1:]) < kernels_weights.shape[0])
             ):
                 kernels_weights = _select_kernels_with_pca(
-                    kernels_weights, out_channels, verbose=verbose
+                    kernels_weights, out_channels, device=device, verbose=verbose
                 )
 
             elif (out_channels is not None) and (
@@ -1871,6 +2017,152 @@ def _initialize_convNd_weights(
     return kernels_weights, bias_weights
 
 
+def _normalize_spatial(params, is_3d):
+    """Get the kernel size, stride, padding and dilation of a layer as tuples.
+
+    Integer parameters are repeated for each of the spatial dimensions.
+
+    Parameters
+    ----------
+    params : dict
+        The layer parameters.
+    is_3d : bool
+        If True, the layer has three spatial dimensions, otherwise two.
+
+    Returns
+    -------
+    tuple
+        The kernel size, stride, padding and dilation tuples.
+
+    """
+    n_dims = 3 if is_3d else 2
+
+    def to_tuple(value):
+        if isinstance(value, (list, tuple)):
+            return tuple(value)
+        return (value,) * n_dims
+
+    return (
+        to_tuple(params["kernel_size"]),
+        to_tuple(params.get("stride", 1)),
+        to_tuple(params.get("padding", 0)),
+        to_tuple(params.get("dilation", 1)),
+    )
+
+
+def _memory_format(is_3d):
+    """Channels last memory format, used by the layers while building.
+
+    Convolutions and batch norms have faster NHWC kernels on both CPU and GPU.
+
+    """
+    return torch.channels_last_3d if is_3d else torch.channels_last
+
+
+def _to_chw_tensor(images, device):
+    """Convert images to a channels first float32 tensor on `device`.
+
+    The images are converted and copied to the device once, \
+    so batches are slices of the returned tensor. \
+    The tensor is in the channels last memory format, \
+    which for 2D images is a view of the :math:`(N, H, W, C)` array. \
+    Tensors, the outputs of the previous layers, \
+    are already channels first and are returned as they are.
+
+    Parameters
+    ----------
+    images : ndarray or torch.Tensor
+        Images with shape :math:`(N, H, W, C)` or :math:`(N, H, W, D, C)`, \
+        or channels first tensor.
+    device : str
+        Device where the tensor is copied to.
+
+    Returns
+    -------
+    torch.Tensor
+        Tensor with shape :math:`(N, C, H, W)` or :math:`(N, C, D, H, W)`.
+
+    """
+    if isinstance(images, torch.Tensor):
+        memory_format = _memory_format(images.ndim == 5)
+        return images.to(device).contiguous(memory_format=memory_format)
+
+    torch_images = torch.as_tensor(images, dtype=torch.float32)
+
+    is_3d = torch_images.ndim == 5
+    if is_3d:
+        torch_images = torch_images.permute(0, 4, 3, 1, 2)
+    else:
+        torch_images = torch_images.permute(0, 3, 1, 2)
+
+    torch_images = torch_images.contiguous(memory_format=_memory_format(is_3d))
+
+    if torch.device(device).type == "cuda":
+        torch_images = torch_images.pin_memory().to(device, non_blocking=True)
+    else:
+        torch_images = torch_images.to(device)
+
+    return torch_images
+
+
+def _empty_outputs(n, output):
+    """Allocate the buffer for the outputs of `n` images.
+
+    The outputs of each batch are copied into their slice of the buffer, \
+    which is on the device of `output` and in its memory format, \
+    so the next layer reads it without any conversion. \
+    On CUDA devices, outputs that would take more than half of the free \
+    device memory are kept in pinned host memory instead, \
+    so the device does not hold the inputs and the outputs of all images.
+
+    """
+    memory_format = _memory_format(output.ndim == 5)
+    if not output.is_contiguous(memory_format=memory_format):
+        memory_format = torch.contiguous_format
+
+    device = output.device
+    pin_memory = False
+    if device.type == "cuda":
+        nbytes = n * output[0].numel() * output.element_size()
+        if nbytes > torch.cuda.mem_get_info(device)[0] // 2:
+            device, pin_memory = torch.device("cpu"), True
+
+    return torch.empty(
+        (n, *output.shape[1:]),
+        dtype=output.dtype,
+        device=device,
+        memory_format=memory_format,
+        pin_memory=pin_memory,
+    )
+
+
+def _to_hwc(images):
+    """Channels last view of a channels first tensor.
+
+    Arrays are already channels last and are returned as they are.
+
+    """
+    if not isinstance(images, torch.Tensor):
+        return images
+
+    if images.ndim == 5:
+        return images.permute(0, 3, 4, 2, 1)
+    return images.permute(0, 2, 3, 1)
+
+
+def _to_hwc_array(images):
+    """Convert a channels first tensor back to a channels last ndarray.
+
+    The activations are only copied to the host when a layer needs them \
+    as an ndarray. For CPU tensors the array is a view of the tensor.
+
+    """
+    images = _to_hwc(images)
+    if isinstance(images, torch.Tensor):
+        images = images.detach().cpu().numpy()
+    return images
+
+
 def _kernels_to_channel_first(kernels_weights):
     if kernels_weights.ndim == 4:
         kernels_weights = kernels_weights.transpose(0, 3, 1, 2)
@@ -1905,11 +2197,13 @@ def _compute_similarity_matrix(filters):
     """
     assert filters is not None, "Filter must be provided"
 
-    _filters = filters.detach().flatten(1).cpu().numpy()
-
-    similiraty_matrix = distance.pdist(_filters, metric=np.inner)
+    # all inner products with a single matrix product on the filters' device
+    with torch.no_grad():
+        _filters = filters.flatten(1)
+        similarity_matrix = _filters @ _filters.T
+        similarity_matrix.fill_diagonal_(0)
 
-    return distance.squareform(similiraty_matrix)
+    return similarity_matrix.cpu().numpy()
 
 
 def _remove_similar_filters(layer, similarity_level=0.85):
@@ -1930,31 +2224,35 @@ def _remove_similar_filters(layer, similarity_level=0.85):
 
     filters = layer.weight
 
-    similarity_matrix = _compute_similarity_matrix(filters)
+    # a filter can only be removed by a kept filter before it
+    similar = np.triu(_compute_similarity_matrix(filters) >= similarity_level, k=1)
 
-    keep_filter = np.full(filters.size(0), True, np.bool)
+    keep_filter = np.full(filters.size(0), True, bool)
 
+    # greedy: each kept filter removes the filters similar to it
     for i in range(0, filters.size(0)):
         if keep_filter[i]:
+            keep_filter &= ~similar[i]
 
-            mask = similarity_matrix[i] >= similarity_level
-            indices = np.where(mask)
-
-            keep_filter[indices] = False
-
-    selected_filters = filters[keep_filter]
+    keep_filter = torch.from_numpy(keep_filter).to(filters.device)
+    selected_filters = filters.detach()[keep_filter]
 
     out_channels = selected_filters.size(0)
 
-    new_conv = nn.Conv2d(
+    new_conv = type(layer)(
         layer.in_channels,
         out_channels,
         kernel_size=layer.kernel_size,
         stride=layer.stride,
-        bias=layer.bias,
         padding=layer.padding,
+        dilation=layer.dilation,
+        groups=layer.groups,
+        bias=layer.bias is not None,
+        padding_mode=layer.padding_mode,
     )
 
     new_conv.weight = nn.Parameter(selected_filters)
+    if layer.bias is not None:
+        new_conv.bias = nn.Parameter(layer.bias.detach()[keep_filter])
 
     return new_conv
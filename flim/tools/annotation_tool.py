@@ -7,7 +7,6 @@ import napari
 import numpy as np
 from magicgui import magicgui
 from magicgui.widgets import FloatSlider
-from numba import jit
 from PIL import Image
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QCursor
@@ -47,17 +46,18 @@ def get_arguments():
 def load_label_image(label_path):
     if label_path.endswith(".txt"):
         with open(label_path, "r") as f:
-            lines = f.readlines()
-        label_infos = [int(info) for info in lines[0].split(" ")]
+            label_infos = [int(info) for info in f.readline().split(" ")]
 
-        # images dimensions are flipped
-        image_shape = (label_infos[2], label_infos[1])
-        label_image = np.zeros(image_shape, dtype=np.int32)
+            # images dimensions are flipped
+            image_shape = (label_infos[2], label_infos[1])
+            label_image = np.zeros(image_shape, dtype=np.int32)
 
-        for line in lines[1:]:
-            split_line = line.split(" ")
-            y, x, label = int(split_line[0]), int(split_line[1]), int(split_line[3])
-            label_image[x][y] = label
+            # all the "y x -1 label" lines at once
+            if label_infos[0] > 0:
+                y, x, label = np.loadtxt(
+                    f, dtype=np.int32, usecols=(0, 1, 3), ndmin=2, unpack=True
+                )
+                label_image[x, y] = label
 
         assert (label_image != 0).sum() == label_infos[
             0
@@ -83,10 +83,18 @@ def _save_markers(markers, markers_dir):
 
     x_coords, y_coords = np.where(mask)
 
-    with open(markers_dir, "w") as f:
-        f.write(f"{number_of_markers} {markers_shape[1]} {markers_shape[0]}\n")
-        for x, y in zip(x_coords, y_coords):
-            f.write(f"{y} {x} {-1} {markers[x][y]}\n")
+    # a line "y x -1 label" for each marker pixel, formatted in a single call
+    lines = np.column_stack(
+        [y_coords, x_coords, np.full_like(x_coords, -1), markers[x_coords, y_coords]]
+    )
+
+    np.savetxt(
+        markers_dir,
+        lines,
+        fmt="%d",
+        header=f"{number_of_markers} {markers_shape[1]} {markers_shape[0]}",
+        comments="",
+    )
 
 
 def image_to_ift_mimage(image):
@@ -133,21 +141,32 @@ def get_superpixels_of_image(image, n_superpixels):
 def get_superpixels_centers(superpixels):
     center = np.full((superpixels.max() + 1, 2), 0)
 
-    for i in range(1, superpixels.max() + 1):
-        mask = superpixels == i
-        center[i] = np.round(np.argwhere(mask).mean(axis=0))
+    # the coordinates sums of all superpixels in a single pass
+    labels = superpixels.ravel()
+    n_labels = center.shape[0]
+    counts = np.bincount(labels, minlength=n_labels)
+    rows, cols = np.indices(superpixels.shape).reshape(2, -1)
+    sums = np.stack(
+        [
+            np.bincount(labels, weights=rows, minlength=n_labels),
+            np.bincount(labels, weights=cols, minlength=n_labels),
+        ],
+        axis=1,
+    )
+
+    has_pixels = counts > 0
+    has_pixels[0] = False
+    center[has_pixels] = np.round(sums[has_pixels] / counts[has_pixels, None])
 
     return center
 
 
 def get_superpixels_roots(superpixels, root_image):
-    indices = np.arange(0, root_image.shape[0] * root_image.shape[1]).reshape(
-        root_image.shape
-    )
+    # the roots are the pixels whose root is their own flat index
+    flat_roots = root_image.ravel()
+    roots = np.flatnonzero(flat_roots == np.arange(flat_roots.size))
 
-    roots = np.argwhere(root_image == indices)
-
-    return roots
+    return np.column_stack(np.unravel_index(roots, root_image.shape))
 
 
 def get_markers_from_superpixels(image):
@@ -159,40 +178,37 @@ def get_markers_from_superpixels(image):
     return image_markers.astype(np.int32)
 
 
-@jit
-def turn_superpixels_in_markers(superpixels, markers):
-    new_markers = np.zeros_like(markers)
+def _superpixels_with_markers(superpixels, markers_mask):
+    """Flag the superpixels that have at least one pixel in `markers_mask`."""
+    has_markers = np.zeros(superpixels.max() + 1, dtype=bool)
+    has_markers[superpixels[markers_mask]] = True
 
-    labels = np.unique(superpixels)
+    return has_markers
 
-    markers_mask = markers != 0
 
-    for label in labels:
-        superpixel_mask = superpixels == label
-        # flag = np.any(np.logical_and(markers_mask, superpixel_mask))
-        marker_label = markers_mask[superpixel_mask].max()
+def turn_superpixels_in_markers(superpixels, markers):
+    new_markers = np.zeros_like(markers)
 
-        new_markers[superpixel_mask] = marker_label
+    # a single pass over the pixels, instead of a mask per superpixel
+    has_markers = _superpixels_with_markers(superpixels, markers != 0)
+    new_markers[...] = has_markers[superpixels]
 
     return new_markers
 
 
-@jit
-def turn_superpixels_borders_in_markers(superpixels, markers):
+def turn_superpixels_borders_in_markers(superpixels, markers, boundaries=None):
     new_markers = np.zeros_like(markers)
 
-    labels = np.unique(superpixels)
+    # the boundaries only change with the superpixels, callers may pass them
+    if boundaries is None:
+        boundaries = find_boundaries(superpixels, connectivity=2, mode="inner")
+    boundaries = boundaries != 0
 
-    markers_mask = markers != 0
-    boundaries = find_boundaries(superpixels, connectivity=2, mode="inner").astype(
-        np.int32
+    # only the markers on the borders of a superpixel mark its borders
+    has_markers = _superpixels_with_markers(
+        superpixels, np.logical_and(markers != 0, boundaries)
     )
-    for label in labels:
-        superpixel_mask = np.logical_and(superpixels == label, boundaries)
-        # flag = np.any(np.logical_and(markers_mask, superpixel_mask))
-        marker_label = markers_mask[superpixel_mask].max()
-
-        new_markers[superpixel_mask] = marker_label
+    new_markers[boundaries] = has_markers[superpixels[boundaries]]
 
     return new_markers
 
@@ -242,10 +258,13 @@ def create_viewer(
     viewer = napari.Viewer(title="Interative tool.")
     viewer.add_image(image, name="image")
 
+    # computed once for each set of superpixels, see propagate_markers
+    super_pixels_boundaries = find_boundaries(
+        super_pixels, connectivity=2, mode="inner"
+    )
+
     if super_pixels is not None:
-        boundaries = find_boundaries(super_pixels, connectivity=2, mode="inner").astype(
-            np.int32
-        )
+        boundaries = super_pixels_boundaries.astype(np.int32)
         boundaries[boundaries != 0] = 9
         viewer.add_labels(boundaries, name="superpixels", opacity=1)
     else:
@@ -279,7 +298,9 @@ def create_viewer(
         @magicgui(call_button="Propagate markers")
         def propagate_markers():
             markers = viewer.layers["markers"].data
-            new_markers = turn_superpixels_borders_in_markers(super_pixels, markers)
+            new_markers = turn_superpixels_borders_in_markers(
+                super_pixels, markers, super_pixels_boundaries
+            )
             viewer.layers["markers"].data = new_markers
 
         @magicgui(
@@ -287,12 +308,15 @@ def create_viewer(
             n_superpixels={"widget_type": FloatSlider, "max": 5000},
         )
         def compute_superpixels(n_superpixels=0):
-            nonlocal super_pixels
+            nonlocal super_pixels, super_pixels_boundaries
             n_superpixels = math.floor(n_superpixels)
             with wait_cursor():
                 if n_superpixels > 0:
                     print(n_superpixels)
                     super_pixels, _ = get_superpixels_of_image(image, n_superpixels)
+                    super_pixels_boundaries = find_boundaries(
+                        super_pixels, connectivity=2, mode="inner"
+                    )
                     boundaries = find_boundaries(
                         super_pixels, connectivity=1, mode="inner"
                     ).astype(np.int32)
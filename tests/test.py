@@ -1,13 +1,29 @@
+import os
+import tempfile
 import unittest
 from collections import OrderedDict
 from math import ceil
 from os import path
 from unittest import TestCase
 
+import numpy as np
 import torch
+from PIL import Image
 
+from flim.experiments import LIDSDataset, lab_normalize
 from flim.experiments import utils as flim_utils
+from flim.experiments._color import _RGB_TO_XYZ
+from flim.experiments._image_utils import image_to_lab
 from flim.models.lcn import LCNCreator, LIDSConvNet
+from flim.models.lcn._creator import (
+    _generate_patches,
+    _generate_patches_on_device,
+    _kmeans_roots,
+    _pooling_markers,
+    _prepare_markers,
+    _remove_similar_filters,
+    _select_kernels_with_pca,
+)
 
 if torch.cuda.is_available():
     device = torch.device("cuda")
@@ -291,5 +307,269 @@ class TestTrainDilation(TestCase):
         self.assertEqual(output.shape, torch.Size([1, 64, 256 // 4, 256 // 4]))
 
 
+class TestGeneratePatches(TestCase):
+    def test_generate_patches_on_device(self):
+        random_state = np.random.RandomState(42)
+        images = random_state.rand(2, 15, 13, 3).astype(np.float32)
+        markers = random_state.randint(0, 3, (2, 15, 13)) * (
+            random_state.rand(2, 15, 13) > 0.8
+        )
+
+        patches, labels = _generate_patches(images, markers, 3, [5, 3], [2, 1])
+        device_patches, device_labels = _generate_patches_on_device(
+            images, markers, [5, 3], [2, 1], device
+        )
+
+        np.testing.assert_array_equal(device_patches.cpu().numpy(), patches)
+        np.testing.assert_array_equal(device_labels.cpu().numpy(), labels)
+
+    def test_generate_patches_3d(self):
+        random_state = np.random.RandomState(42)
+        images = random_state.rand(2, 7, 6, 5, 2).astype(np.float32)
+        markers = np.zeros((2, 7, 6, 5), dtype=np.int32)
+        markers[0, 1, 2, 4] = 1
+        markers[1, 6, 0, 3] = 2
+
+        patches, labels = _generate_patches(images, markers, 2, [3, 3, 3], [1, 1, 1])
+
+        np.testing.assert_array_equal(labels, [0, 1])
+        np.testing.assert_array_equal(patches[0, 1, 1, 1], images[0, 1, 2, 4])
+        np.testing.assert_array_equal(patches[1, 1, 1, 1], images[1, 6, 0, 3])
+        # voxels out of the image are zero
+        np.testing.assert_array_equal(patches[0, :, :, 2], 0)
+
+
+class TestKMeansRoots(TestCase):
+    def test_kmeans_roots(self):
+        from sklearn.cluster import KMeans
+
+        random_state = np.random.RandomState(0)
+        patches = random_state.rand(300, 3, 3, 3).astype(np.float32)
+        labels = random_state.randint(0, 4, 300)
+
+        roots = _kmeans_roots(patches, labels, 8)
+
+        # small labels are clustered with the exact k-means
+        expected = [
+            KMeans(n_clusters=8, max_iter=100, tol=0.001, random_state=42, n_init=10)
+            .fit(patches[labels == label].reshape(-1, 27))
+            .cluster_centers_
+            for label in range(4)
+        ]
+        np.testing.assert_allclose(
+            roots.reshape(32, -1), np.concatenate(expected), atol=1e-5
+        )
+
+
+class TestMarkers(TestCase):
+    def test_prepare_markers(self):
+        markers = np.zeros((2, 3, 2), dtype=np.int32)
+        markers[0, 0, 1] = 1
+        markers[0, 2, 0] = 2
+        markers[1, 1, 1] = 1
+
+        markers_by_image = _prepare_markers(markers)
+
+        # the labels of an image are shifted when it has more than one label
+        self.assertEqual(len(markers_by_image), 2)
+        np.testing.assert_array_equal(markers_by_image[0], [[0, 2], [1, 0], [0, 1]])
+        np.testing.assert_array_equal(markers_by_image[1], [[1], [1], [1]])
+
+    def test_pooling_markers(self):
+        markers = np.zeros((1, 5, 5), dtype=np.int32)
+        markers[0, 0, 0] = 1
+        markers[0, 2, 2] = 4
+        markers[0, 3, 4] = 2
+        markers[0, 4, 1] = 3
+
+        new_markers = _pooling_markers(markers, 3, stride=2, padding=1)
+
+        expected = np.zeros((1, 3, 3), dtype=np.int32)
+        expected[0, 0, 0] = 1
+        expected[0, 1, 1] = 4
+        expected[0, 1, 2] = 2
+        expected[0, 2, 0] = 3
+        np.testing.assert_array_equal(new_markers, expected)
+
+        # without padding, the markers out of the last window are dropped
+        new_markers = _pooling_markers(markers, 3, stride=2)
+
+        expected = np.zeros((1, 2, 2), dtype=np.int32)
+        expected[0, 0, 0] = 1
+        expected[0, 1, 1] = 4
+        np.testing.assert_array_equal(new_markers, expected)
+
+
+class TestRemoveSimilarFilters(TestCase):
+    def test_remove_similar_filters(self):
+        layer = torch.nn.Conv2d(3, 4, kernel_size=3, padding=1, bias=True)
+        with torch.no_grad():
+            weight = torch.eye(4, 27).view(4, 3, 3, 3)
+            weight[2] = weight[0]
+            layer.weight.copy_(weight)
+
+        new_layer = _remove_similar_filters(layer, similarity_level=0.85)
+
+        self.assertEqual(new_layer.out_channels, 3)
+        self.assertEqual(new_layer.padding, layer.padding)
+        torch.testing.assert_close(new_layer.weight, layer.weight[[0, 1, 3]])
+        torch.testing.assert_close(new_layer.bias, layer.bias[[0, 1, 3]])
+
+
+class TestSelectKernelsWithPCA(TestCase):
+    def test_select_kernels_with_pca(self):
+        from sklearn.decomposition import PCA
+
+        kernels = np.random.RandomState(0).rand(60, 3, 3, 3).astype(np.float32)
+
+        kernels_pca = _select_kernels_with_pca(kernels, 8, device=device)
+
+        expected = PCA(n_components=8, svd_solver="full").fit(kernels.reshape(60, -1))
+        self.assertEqual(kernels_pca.shape, (8, 3, 3, 3))
+        np.testing.assert_allclose(
+            kernels_pca.reshape(8, -1), expected.components_, atol=1e-4
+        )
+
+    def test_select_kernels_with_randomized_pca(self):
+        random_state = np.random.RandomState(0)
+        # a few strong directions, so the randomized SVD finds the exact subspace
+        basis = np.linalg.qr(random_state.randn(12 * 10 * 10, 5))[0].T
+        kernels = random_state.randn(600, 5) * [100, 80, 60, 40, 20] @ basis
+        kernels += random_state.randn(600, 12 * 10 * 10) * 0.01
+        kernels = kernels.astype(np.float32).reshape(600, 12, 10, 10)
+
+        kernels_pca = _select_kernels_with_pca(kernels, 5, device=device)
+
+        centered = kernels.reshape(600, -1) - kernels.reshape(600, -1).mean(axis=0)
+        components = np.linalg.svd(centered, full_matrices=False)[2][:5]
+        # the same components, up to their signs
+        np.testing.assert_allclose(
+            np.abs(kernels_pca.reshape(5, -1) @ components.T), np.eye(5), atol=1e-3
+        )
+
+
+class TestImageToLab(TestCase):
+    def test_image_to_lab(self):
+        image = np.random.RandomState(42).randint(0, 256, (16, 24, 3), np.uint8)
+
+        rgb = image / image.max()
+        xyz = rgb @ _RGB_TO_XYZ.T
+        t = xyz / np.array([0.950456, 1.0, 1.088754])
+        f = np.where(
+            t >= 8.85645167903563082e-3, np.cbrt(t), (841.0 / 108.0) * t + 4.0 / 29.0
+        )
+        expected = np.stack(
+            [
+                (116 * f[..., 1] - 16) / 99.998337,
+                (500 * (f[..., 0] - f[..., 1]) + 86.182236) / (86.182236 + 98.258614),
+                (200 * (f[..., 1] - f[..., 2]) + 107.867744) / (107.867744 + 94.481682),
+            ],
+            axis=-1,
+        )
+
+        lab = image_to_lab(image)
+
+        self.assertEqual(lab.shape, image.shape)
+        self.assertEqual(lab.dtype, np.float32)
+        np.testing.assert_allclose(lab, expected, atol=1e-5)
+
+    def test_gray_image_to_lab(self):
+        image = np.random.RandomState(42).randint(0, 256, (16, 24), np.uint8)
+
+        lab = image_to_lab(image)
+
+        self.assertEqual(lab.shape, (16, 24, 3))
+        np.testing.assert_allclose(lab, image_to_lab(np.dstack([image] * 3)))
+
+    def test_lab_normalize(self):
+        images = np.random.RandomState(42).randint(0, 256, (2, 16, 24, 3), np.uint8)
+
+        lab = lab_normalize(torch.from_numpy(images).permute(0, 3, 1, 2).to(device))
+
+        self.assertEqual(lab.dtype, torch.float32)
+        for image, lab_image in zip(images, lab.cpu().numpy()):
+            np.testing.assert_allclose(
+                lab_image, image_to_lab(image).transpose(2, 0, 1), atol=1e-5
+            )
+
+
+class TestLIDSDataset(TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.root_dir = path.join(self._tmp_dir.name, "images")
+        os.makedirs(self.root_dir)
+
+        random_state = np.random.RandomState(42)
+        for name in ["000001_000001.png", "000001_000002.png", "000002_000001.png"]:
+            image = random_state.randint(0, 256, (12, 16, 3), np.uint8)
+            Image.fromarray(image).save(path.join(self.root_dir, name))
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_cache_dir(self):
+        cache_dir = path.join(self._tmp_dir.name, "cache")
+        dataset = LIDSDataset(self.root_dir)
+        cached_dataset = LIDSDataset(self.root_dir, cache_dir=cache_dir)
+
+        for _ in range(2):
+            for i in range(len(dataset)):
+                image, label = dataset[i]
+                cached_image, cached_label = cached_dataset[i]
+
+                np.testing.assert_array_equal(image, cached_image)
+                self.assertEqual(label, cached_label)
+
+        self.assertEqual(len(os.listdir(cache_dir)), len(dataset))
+
+    def test_channels_first(self):
+        dataset = LIDSDataset(self.root_dir)
+        chw_dataset = LIDSDataset(self.root_dir, channels_first=True)
+
+        image, _ = dataset[0]
+        for chw_image, _ in [chw_dataset[0], chw_dataset.get_batch([0, 1])[0]]:
+            self.assertIsInstance(chw_image, torch.Tensor)
+            self.assertTrue(chw_image.is_contiguous())
+            np.testing.assert_allclose(
+                chw_image.numpy(), image.transpose(2, 0, 1), atol=1e-6
+            )
+
+    def test_out_dtype(self):
+        dataset = LIDSDataset(self.root_dir, channels_first=True)
+        half_dataset = LIDSDataset(
+            self.root_dir, channels_first=True, out_dtype=torch.float16
+        )
+
+        image, _ = dataset[0]
+        half_image, _ = half_dataset[0]
+
+        self.assertEqual(half_image.dtype, torch.float16)
+        np.testing.assert_allclose(half_image.float(), image, atol=1e-3)
+
+        with self.assertRaises(ValueError):
+            LIDSDataset(self.root_dir, out_dtype=torch.float16)
+
+    def test_weights_for_balance(self):
+        dataset = LIDSDataset(self.root_dir)
+
+        weights = dataset.weights_for_balance(nclasses=2)
+
+        self.assertEqual(weights.dtype, np.float32)
+        labels = [label for _, label in dataset]
+        np.testing.assert_allclose(weights, [[1.5, 3.0][label] for label in labels])
+        np.testing.assert_array_equal(dataset.weights_for_balance(2), weights)
+        self.assertEqual(len(LIDSDataset(self.root_dir)), len(dataset))
+
+    def test_get_batch(self):
+        dataset = LIDSDataset(self.root_dir)
+        indices = [2, 0, 1]
+
+        for (image, label), idx in zip(dataset.get_batch(indices), indices):
+            expected_image, expected_label = dataset[idx]
+
+            np.testing.assert_allclose(image, expected_image, atol=1e-6)
+            self.assertEqual(label, expected_label)
+
+
 if __name__ == "__main__":
     unittest.main()